@@ -1,20 +1,43 @@
-import eventlet
-eventlet.monkey_patch(all=True)
-
+import sys
+if __name__ == '__main__' and sys.argv[1:] in ([], ['run']):
+    # The dev server runs on eventlet like gunicorn's eventlet worker, which patches by itself
+    import eventlet
+    eventlet.monkey_patch(all=True)
+
+import atexit
+import bisect
+import functools
+import gzip
+import hashlib
+import itertools
 import json
+import math
+import mimetypes
 import os
+import platform
+import re
+import sqlite3
 import ssl
-from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from flask import Blueprint, Flask, Response, current_app, g, has_request_context, request, jsonify, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, make_transient_to_detached, selectinload
+from sqlalchemy.orm.attributes import flag_modified
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-from apscheduler.schedulers.background import BackgroundScheduler
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from werkzeug.wsgi import ClosingIterator
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, current_user, decode_token
+from jwt import PyJWTError
 
 # Get the absolute path to the directory where app.py is located
 backend_dir = os.path.dirname(os.path.abspath(__file__))
@@ -31,24 +54,197 @@ for path in possible_dist_paths:
         dist_dir = path
         break
 
-# Initialize Flask with the absolute path to the static folder
-app = Flask(__name__, static_folder=dist_dir, static_url_path='/')
-# Robust CORS for development and production
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+# Extensions and routes are module-level; create_app() binds them to an app
+db = SQLAlchemy()
+jwt = JWTManager()
+socketio = SocketIO()
+bp = Blueprint('flowstate', __name__)
 
-# Initialize SocketIO early to avoid NameError
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+def eventlet_patched():
+    eventlet = sys.modules.get('eventlet')
+    return eventlet is not None and eventlet.patcher.is_monkey_patched('socket')
 
 # Database Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", 'sqlite:///flowstate.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-123')
-app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'super-secret-jwt-key')
-jwt = JWTManager(app)
-
-db = SQLAlchemy(app)
-
-@app.route('/api/health-check', methods=['GET'])
+# Postgres queries must yield to the eventlet hub instead of blocking the worker. DATABASE_DRIVER=psycopg2
+# (default) installs psycopg2 wait callbacks, the psycogreen recipe; pg8000 is pure Python and cooperative
+# through the patched socket module. The driver is pinned in the URL because SQLAlchemy's default changes.
+DATABASE_DRIVER = os.environ.get('DATABASE_DRIVER', 'psycopg2')
+
+def database_url():
+    url = os.environ.get("DATABASE_URL", 'sqlite:///flowstate.db')
+    scheme, _, rest = url.partition('://')
+    if scheme in ('postgres', 'postgresql'):
+        url = f'postgresql+{DATABASE_DRIVER}://{rest}'
+    return url
+
+def make_psycopg2_green():
+    from psycopg2 import extensions, OperationalError
+    from eventlet.hubs import trampoline
+
+    def wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                return
+            if state == extensions.POLL_READ:
+                trampoline(conn.fileno(), read=True)
+            elif state == extensions.POLL_WRITE:
+                trampoline(conn.fileno(), write=True)
+            else:
+                raise OperationalError(f"Bad result from poll: {state}")
+
+    extensions.set_wait_callback(wait_callback)
+
+def default_config():
+    config = {
+        'SQLALCHEMY_DATABASE_URI': database_url(),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'dev-secret-key-123'),
+        'JWT_SECRET_KEY': os.environ.get('JWT_SECRET_KEY', 'super-secret-jwt-key'),
+        'GOOGLE_CLIENT_ID': os.environ.get(
+            'GOOGLE_CLIENT_ID', '765015665790-79inqu25trcn7i8kmd4dq3n4rsse2j5a.apps.googleusercontent.com'
+        ),
+        # Google's signing certs; point at a local JWKS server to run sign-in without network access
+        'GOOGLE_CERTS_URL': os.environ.get('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs'),
+        # With a message queue (e.g. redis://host:6379/0) several workers share one event bus,
+        # so an emit from any worker reaches sockets connected to all of them
+        'SOCKETIO_MESSAGE_QUEUE': os.environ.get('SOCKETIO_MESSAGE_QUEUE'),
+        'RUN_SCHEDULER': os.environ.get('RUN_SCHEDULER', '0') == '1',
+        # Build the frontend file cache when the app starts instead of on the first page load
+        'WARM_STATIC_FILES': True,
+        # orjson (when installed) or stdlib
+        'JSON_PROVIDER': os.environ.get('JSON_PROVIDER', 'orjson'),
+    }
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        }
+    return config
+
+# Metrics: with METRICS=1 every route, socket event and SQL statement is timed into histograms served
+# as Prometheus text on /metrics (per worker process). SLOW_QUERY_MS logs statements slower than that.
+# Nothing is hooked in when both are off.
+METRICS_ENABLED = os.environ.get('METRICS', '0') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> per-bucket counts followed by count and sum
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * len(self.buckets) + [0, 0.0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.series.items())
+        for label_values, series in items:
+            labels = ''.join(f'{k}="{prometheus_label(v)}",' for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {series[-2]}')
+            lines.append(f'{self.name}_sum{{{labels.rstrip(",")}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{labels.rstrip(",")}}} {series[-2]}')
+        return '\n'.join(lines)
+
+HTTP_SECONDS = Histogram('flowstate_http_request_duration_seconds', 'HTTP request latency.', ('method', 'route', 'status'))
+HTTP_SQL_STATEMENTS = Histogram(
+    'flowstate_http_request_sql_statements', 'SQL statements issued per HTTP request.', ('method', 'route'),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+SOCKET_EVENT_SECONDS = Histogram('flowstate_socketio_event_duration_seconds', 'Socket.IO event handler latency.', ('event',))
+SQL_SECONDS = Histogram('flowstate_sql_statement_duration_seconds', 'SQL statement latency.', ('statement',))
+METRICS = (HTTP_SECONDS, HTTP_SQL_STATEMENTS, SOCKET_EVENT_SECONDS, SQL_SECONDS)
+
+def socket_event(event):
+    # socketio.on() that also records the handler's latency when metrics are on
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return socketio.on(event)(fn)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                SOCKET_EVENT_SECONDS.observe(time.perf_counter() - started, event)
+        return socketio.on(event)(timed)
+    return decorator
+
+if METRICS_ENABLED:
+    @bp.before_app_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.sql_statements = 0
+
+    @bp.after_app_request
+    def record_request_metrics(response):
+        if 'metrics_started' in g:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_SECONDS.observe(time.perf_counter() - g.metrics_started, request.method, route, response.status_code)
+            HTTP_SQL_STATEMENTS.observe(g.sql_statements, request.method, route)
+        return response
+
+if METRICS_ENABLED or SLOW_QUERY_MS:
+    @db.event.listens_for(Engine, 'before_cursor_execute')
+    def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @db.event.listens_for(Engine, 'handle_error')
+    def discard_statement_timer(exception_context):
+        # A statement that raises never reaches after_cursor_execute; without this its start time
+        # would stay on the pooled connection for good
+        conn = exception_context.connection
+        if conn is not None and exception_context.statement is not None and conn.info.get('statement_started'):
+            conn.info['statement_started'].pop()
+
+    @db.event.listens_for(Engine, 'after_cursor_execute')
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['statement_started'].pop()
+        if METRICS_ENABLED:
+            verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+            SQL_SECONDS.observe(elapsed, verb if verb in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH') else 'OTHER')
+            if has_request_context() and 'sql_statements' in g:
+                g.sql_statements += 1
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            where = f"{request.method} {request.path}" if has_request_context() else 'background'
+            print(f"Slow query ({elapsed * 1000:.0f} ms, {where}): {' '.join(statement.split())[:1000]}")
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({'status': 'error', 'message': 'Metrics are disabled'}), 404
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    body = '\n'.join(metric.render() for metric in METRICS) + '\n'
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@bp.route('/api/health-check', methods=['GET'])
 def health_check():
     status = {"status": "online", "db": "unknown", "error": None}
     try:
@@ -65,23 +261,62 @@ def health_check():
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
+    # Lowercased username so case-insensitive lookups can use an index instead of ilike; unique, so
+    # "Bob" and "bob" cannot both register (see migrate_unique_username_key for older duplicates)
+    username_key = db.Column(db.String(80), index=True, unique=True)
     email = db.Column(db.String(120), unique=True)
     password = db.Column(db.String(120)) 
     profile_pic = db.Column(db.String(200))
     level = db.Column(db.Integer, default=1)
     xp = db.Column(db.Integer, default=0)
     total_focus_hours = db.Column(db.Float, default=0.0)
+    # Legacy JSON blob of per-day focus hours, superseded by FocusDaily and emptied by migration 0002
     daily_stats = db.Column(db.Text, default='{}')
+    # Last version handed out to this user's synced rows, see /api/sync
+    sync_version = db.Column(db.BigInteger, nullable=False, default=0)
     habits = db.relationship('Habit', backref='user', lazy=True)
 
-    def get_stats(self):
-        return json.loads(self.daily_stats or '{}')
+    @db.validates('username')
+    def _set_username_key(self, key, value):
+        self.username_key = value.lower()
+        return value
+
+    def get_stats(self, days=30):
+        since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        rows = FocusDaily.query.filter(FocusDaily.user_id == self.id, FocusDaily.date >= since).order_by(FocusDaily.date)
+        return {row.date: row.hours for row in rows}
     
     def update_stats(self, date_str, hours):
-        stats = self.get_stats()
-        stats[date_str] = stats.get(date_str, 0) + hours
-        self.daily_stats = json.dumps(stats)
-        self.total_focus_hours += hours
+        # Both counters are incremented in SQL so concurrent tracks from several devices add up;
+        # returns the new total
+        db.session.execute(increment_focus_daily(db.engine.dialect.name, self.id, date_str, hours))
+        total = db.session.execute(
+            db.update(User).where(User.id == self.id)
+            .values(total_focus_hours=db.func.coalesce(User.total_focus_hours, 0) + hours)
+            .returning(User.total_focus_hours)
+        ).scalar_one()
+        forget_user(self.id)
+        return total
+
+class FocusDaily(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    date = db.Column(db.String(10), primary_key=True) # Store as string YYYY-MM-DD
+    hours = db.Column(db.Float, nullable=False, default=0.0)
+
+def dialect_insert(dialect_name, model_or_table):
+    # INSERT that supports ON CONFLICT on both supported backends
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model_or_table)
+
+def increment_focus_daily(dialect_name, user_id, date_str, hours):
+    stmt = dialect_insert(dialect_name, FocusDaily.__table__).values(user_id=user_id, date=date_str, hours=hours)
+    return stmt.on_conflict_do_update(
+        index_elements=['user_id', 'date'],
+        set_={'hours': FocusDaily.__table__.c.hours + stmt.excluded.hours}
+    )
 
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -92,10 +327,16 @@ class Task(db.Model):
     total_hours = db.Column(db.Integer, default=1)
     hours = db.Column(db.Integer, default=0)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    subtasks = db.relationship('SubTask', backref='task', lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_task_user_version', 'user_id', 'version'),
+    )
 
 class SubTask(db.Model):
     id = db.Column(db.String(36), primary_key=True)
-    task_id = db.Column(db.String(36), db.ForeignKey('task.id'))
+    task_id = db.Column(db.String(36), db.ForeignKey('task.id'), index=True)
     title = db.Column(db.String(200), nullable=False)
     completed = db.Column(db.Boolean, default=False)
 
@@ -106,6 +347,13 @@ class Message(db.Model):
     sender = db.Column(db.String(80), nullable=False)
     receiver = db.Column(db.String(80), nullable=True) # For private chats
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Same value for both directions of a private chat, see conversation_key()
+    conversation = db.Column(db.String(161))
+
+    __table_args__ = (
+        db.Index('ix_message_conversation_id', 'conversation', 'id'),
+        db.Index('ix_message_sender_receiver_timestamp', 'sender', 'receiver', 'timestamp'),
+    )
 
 class Event(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -114,6 +362,11 @@ class Event(db.Model):
     time = db.Column(db.String(20), nullable=False) # Store as string HH:MM
     category = db.Column(db.String(50))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_event_user_version', 'user_id', 'version'),
+    )
 
 class Friendship(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -121,6 +374,10 @@ class Friendship(db.Model):
     friend_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     status = db.Column(db.String(20), default='pending') # pending, accepted
 
+    __table_args__ = (
+        db.Index('ix_friendship_user_status_friend', 'user_id', 'status', 'friend_id'),
+    )
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -130,85 +387,800 @@ class Notification(db.Model):
     type = db.Column(db.String(20)) # friend_request, achievement, mission
     read = db.Column(db.Boolean, default=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Chat messages coalesce into one unread notification per sender, see upsert_message_notifications()
+    count = db.Column(db.Integer, nullable=False, default=1)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_notification_user_read_timestamp', 'user_id', 'read', 'timestamp'),
+        # Lists are ordered by (timestamp, id): a bumped chat notification keeps its id but moves to the top
+        db.Index('ix_notification_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_notification_user_version', 'user_id', 'version'),
+        db.Index(
+            'uq_notification_unread_message', 'user_id', 'sender_username', unique=True,
+            sqlite_where=text("type = 'message' AND NOT read"),
+            postgresql_where=text("type = 'message' AND NOT read")
+        ),
+    )
+
+    def to_dict(self):
+        message = self.message
+        if self.type == 'message' and self.count > 1:
+            message = f"You received {self.count} new messages from {self.sender_username}"
+        return {
+            'id': self.id,
+            'title': self.title,
+            'message': message,
+            'count': self.count,
+            'sender': self.sender_username,
+            'type': self.type,
+            'read': self.read,
+            'time': self.timestamp.strftime('%H:%M')
+        }
+
+UNREAD_MESSAGE_NOTIFICATION = text("type = 'message' AND NOT read")
+
+def upsert_message_notifications(rows):
+    # Inserts message notifications, or bumps the count and time of the recipient's unread
+    # notification from the same sender. Rows for the same pair are merged first because one
+    # INSERT ... ON CONFLICT may not touch the same row twice.
+    merged = {}
+    for row in rows:
+        key = (row['user_id'], row['sender_username'])
+        if key in merged:
+            merged[key]['count'] += row.get('count', 1)
+            merged[key]['timestamp'] = row['timestamp']
+        else:
+            merged[key] = dict(row, count=row.get('count', 1))
+    versions = bump_sync_versions(sorted({user_id for user_id, _ in merged}))
+    for (user_id, _), row in merged.items():
+        row['version'] = versions[user_id]
+
+    table = Notification.__table__
+    stmt = dialect_insert(db.engine.dialect.name, table).values(list(merged.values()))
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'sender_username'],
+        index_where=UNREAD_MESSAGE_NOTIFICATION,
+        set_={
+            'count': table.c['count'] + stmt.excluded['count'],
+            'timestamp': stmt.excluded.timestamp,
+            'version': stmt.excluded.version
+        }
+    ))
 
 class Habit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     title = db.Column(db.String(100), nullable=False)
-    # Binary string for 7 days: "1011001" (1=done, 0=not)
+    # Legacy binary string for 7 days, superseded by HabitWeek.mask and no longer written
     weekly_completion = db.Column(db.String(7), default='0000000')
+    # Consecutive fully completed weeks before the current one, advanced by the weekly rollover job
     streak = db.Column(db.Integer, default=0)
+    # Also bumped when this week's HabitWeek row changes, since the synced habit includes it
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_habit_user_version', 'user_id', 'version'),
+    )
+
+class HabitWeek(db.Model):
+    # One row per habit and week; bit i of mask is day i (0 = Monday) of that week.
+    # Weeks are numbered so that consecutive weeks are consecutive integers, see week_number().
+    habit_id = db.Column(db.Integer, db.ForeignKey('habit.id'), primary_key=True)
+    week = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    mask = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_habit_week_user_week', 'user_id', 'week'),
+    )
+
+FULL_WEEK = 0b1111111
+
+def week_number(day=None):
+    # date.fromordinal(1) is a Monday, so this counts whole Monday-based weeks
+    return ((day or date.today()).toordinal() - 1) // 7
+
+def week_start(week):
+    return date.fromordinal(week * 7 + 1)
+
+def mask_to_completion(mask):
+    return ''.join('1' if mask >> day & 1 else '0' for day in range(7))
+
+def completion_to_mask(completion):
+    return sum(1 << day for day, done in enumerate(completion[:7]) if done == '1')
+
+def days_done(mask_column):
+    # Population count of the 7 day bits, in SQL
+    return sum(mask_column.op('>>')(day).op('&')(1) for day in range(7))
+
+def upsert_habit_week(habit, insert_mask, update_mask):
+    stmt = dialect_insert(db.engine.dialect.name, HabitWeek.__table__).values(
+        habit_id=habit.id, week=week_number(), user_id=habit.user_id, mask=insert_mask
+    )
+    stmt = stmt.on_conflict_do_update(index_elements=['habit_id', 'week'], set_={'mask': update_mask})
+    return db.session.execute(stmt.returning(HabitWeek.__table__.c.mask)).scalar()
+
+def set_habit_day(habit, day, done=None):
+    # Toggles (done=None), sets or clears one day of this week with an atomic bitwise update
+    bit = 1 << day
+    mask = HabitWeek.__table__.c.mask
+    if done is None:
+        # XOR spelled with | and &, which both SQLite and Postgres support
+        return upsert_habit_week(habit, bit, mask.op('|')(bit) - mask.op('&')(bit))
+    if done:
+        return upsert_habit_week(habit, bit, mask.op('|')(bit))
+    return upsert_habit_week(habit, 0, mask.op('&')(FULL_WEEK ^ bit))
+
+def set_habit_completion(habit, completion):
+    mask = completion_to_mask(completion)
+    return upsert_habit_week(habit, mask, mask)
+
+def habit_days_done(user_id, week=None):
+    # (title, days done) for each of the user's habits in the given week, counted in SQL
+    return db.session.query(Habit.title, db.func.coalesce(days_done(HabitWeek.mask), 0)).outerjoin(
+        HabitWeek, db.and_(HabitWeek.habit_id == Habit.id, HabitWeek.week == (week or week_number()))
+    ).filter(Habit.user_id == user_id).all()
+
+class JobRun(db.Model):
+    # One row per scheduled job: a lease so a single worker runs it, its progress and last result
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100))
+    lease_expires_at = db.Column(db.DateTime)
+    period = db.Column(db.String(20)) # Period of the latest run, e.g. 2026-W42
+    cursor = db.Column(db.Integer, default=0) # Last row id processed in that period
+    completed = db.Column(db.Boolean, default=False)
+    rows = db.Column(db.Integer, default=0)
+    duration_ms = db.Column(db.Integer)
+
+# Delta sync (/api/sync): every insert, update or delete of a user's tasks (a subtask counts as a
+# change to its task), events, habits and notifications stamps the row with the user's next
+# sync_version, and deletes leave a tombstone. Bumping the counter locks the user row until commit,
+# so one user's versions become visible in order and "everything above the cursor" never skips a
+# transaction that committed late. ORM changes are stamped by the before_flush hook below; bulk
+# statements go through update_synced() and delete_synced().
+SYNC_COLLECTIONS = {Task: 'tasks', Event: 'events', Habit: 'habits', Notification: 'notifications'}
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', 30))
+TOMBSTONE_PURGE_BATCH = 1000
+
+class Tombstone(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    collection = db.Column(db.String(20), nullable=False)
+    row_id = db.Column(db.String(36), nullable=False)
+    version = db.Column(db.BigInteger, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_tombstone_user_version', 'user_id', 'version'),
+    )
+
+def bump_sync_versions(user_ids, session=None):
+    # {user id: new version}; user_ids can also be a SELECT of ids
+    users = User.__table__
+    stmt = users.update().where(users.c.id.in_(user_ids)).values(sync_version=users.c.sync_version + 1)
+    return dict((session or db.session).execute(stmt.returning(users.c.id, users.c.sync_version)).all())
+
+def owner_sync_version(model):
+    # The owner's version in bulk statements, after bump_sync_versions() in the same transaction
+    return db.select(User.sync_version).where(User.id == model.user_id).scalar_subquery()
+
+def update_synced(model, values, *criteria):
+    bump_sync_versions(db.select(model.user_id).where(*criteria))
+    values = dict(values, **{model.version.key: owner_sync_version(model)})
+    return model.query.filter(*criteria).update(values, synchronize_session=False)
+
+def delete_synced(model, *criteria):
+    bump_sync_versions(db.select(model.user_id).where(*criteria))
+    tombstones = db.select(
+        model.user_id, db.literal(SYNC_COLLECTIONS[model]), db.cast(model.id, db.String),
+        owner_sync_version(model), db.literal(datetime.utcnow())
+    ).where(*criteria)
+    db.session.execute(Tombstone.__table__.insert().from_select(
+        ['user_id', 'collection', 'row_id', 'version', 'deleted_at'], tombstones
+    ))
+    return model.query.filter(*criteria).delete(synchronize_session=False)
+
+def touch(row):
+    # Re-stamps a synced row whose own columns did not change, e.g. a habit whose week did
+    flag_modified(row, 'version')
+
+@db.event.listens_for(Session, 'before_flush')
+def _stamp_sync_versions(session, flush_context, instances):
+    deleting = session.deleted
+    stamped, deleted = [], []
+    for obj in list(session.new) + [o for o in session.dirty if session.is_modified(o)] + list(deleting):
+        if isinstance(obj, SubTask):
+            obj = session.get(Task, obj.task_id) if obj.task_id else None
+            if obj in deleting:
+                continue
+        if type(obj) not in SYNC_COLLECTIONS or obj.user_id is None:
+            continue
+        (deleted if obj in deleting else stamped).append(obj)
+    if not stamped and not deleted:
+        return
+
+    versions = bump_sync_versions(sorted({obj.user_id for obj in stamped + deleted}), session)
+    for obj in stamped:
+        obj.version = versions[obj.user_id]
+    for obj in deleted:
+        session.add(Tombstone(
+            user_id=obj.user_id, collection=SYNC_COLLECTIONS[type(obj)], row_id=str(obj.id), version=versions[obj.user_id]
+        ))
+
+# User resolution: JWTs carry the numeric id as the `uid` claim, so an authenticated request
+# costs at most one primary-key fetch, done once by the user_lookup_loader below.
+# USER_CACHE_TTL (seconds, off by default) additionally caches that row in this process; entries
+# are dropped whenever this process writes the user, other workers may serve them stale for the TTL.
+# At most USER_CACHE_SIZE users are kept, least recently used first out.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 0))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+_user_cache = OrderedDict()  # user id -> (expires_at, column values), least recently used first
+_user_cache_lock = threading.Lock()
+
+def find_user(username):
+    username = username or ''
+    user = User.query.filter_by(username_key=username.lower()).first()
+    if user is not None and user.username != username:
+        # Accounts that differ only in case from an older one predate the unique key and were given
+        # a disambiguated key by the migration; they still sign in with their exact username
+        user = User.query.filter_by(username=username).first() or user
+    return user
+
+def get_user_by_id(user_id):
+    entry = None
+    if USER_CACHE_TTL:
+        with _user_cache_lock:
+            entry = _user_cache.get(user_id)
+            if entry and entry[0] <= time.monotonic():
+                entry = _user_cache.pop(user_id)
+            elif entry:
+                _user_cache.move_to_end(user_id)
+    if entry and entry[0] > time.monotonic():
+        user = User(**entry[1])
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = db.session.get(User, user_id)
+    if user and USER_CACHE_TTL:
+        values = {c.key: getattr(user, c.key) for c in User.__table__.columns}
+        with _user_cache_lock:
+            _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, values)
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > USER_CACHE_SIZE:
+                _user_cache.popitem(last=False)
+    return user
+
+def forget_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+@db.event.listens_for(Session, 'before_flush')
+def _invalidate_cached_users(session, flush_context, instances):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            forget_user(obj.id)
+
+def user_from_claims(claims):
+    # Tokens issued before the uid claim existed only carry the username
+    if 'uid' in claims:
+        return get_user_by_id(claims['uid'])
+    return find_user(claims['sub'])
+
+@jwt.user_lookup_loader
+def load_user(jwt_header, jwt_data):
+    return user_from_claims(jwt_data)
+
+def issue_token(user):
+    return create_access_token(identity=user.username, additional_claims={'uid': user.id})
 
 # XP Logic
-def add_xp(user, amount):
-    user.xp += amount
-    level_up = False
-    required_xp = user.level * 1000 
-    if user.xp >= required_xp:
-        user.level += 1
-        user.xp -= required_xp
-        level_up = True
-    return level_up
-
-# Initialize database
-with app.app_context():
+# Going from level L to L+1 takes L*1000 XP, so reaching level L takes 500*L*(L-1) XP in total
+# and the level for a total T is floor((1 + sqrt(1 + T/125)) / 2). Exact in doubles well past
+# any real total: at a level boundary 1 + T/125 is a perfect square.
+def add_xp(user_id, amount):
+    # One UPDATE ... RETURNING so concurrent awards add up and several level-ups in one award
+    # are applied; returns (level, xp, level_up)
+    total = 500 * User.level * (User.level - 1) + User.xp + amount
+    level = db.cast(db.func.floor((1 + db.func.sqrt(1 + total / 125.0)) / 2), db.Integer)
+    level, xp = db.session.execute(
+        db.update(User).where(User.id == user_id)
+        .values(level=level, xp=total - 500 * level * (level - 1))
+        .returning(User.level, User.xp)
+    ).one()
+    forget_user(user_id)
+    # The stored xp is always below the next threshold, so it only drops below the award on a level-up
+    return level, xp, xp < amount
+
+@db.event.listens_for(Engine, 'connect')
+def _sqlite_math_functions(dbapi_connection, connection_record):
+    # add_xp needs sqrt() and floor(), which SQLite only has when built with math functions
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        try:
+            dbapi_connection.execute('SELECT sqrt(1), floor(1)')
+        except sqlite3.OperationalError:
+            dbapi_connection.create_function('sqrt', 1, math.sqrt, deterministic=True)
+            dbapi_connection.create_function('floor', 1, math.floor, deterministic=True)
+
+# Schema migrations for databases created before a model changed. create_all() never alters
+# existing tables, so each step runs once, in order, and is recorded in schema_migration.
+class SchemaMigration(db.Model):
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def add_column_if_missing(conn, table, column, ddl_type):
+    if column not in [c['name'] for c in db.inspect(conn).get_columns(table)]:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl_type}'))
+
+def migrate_message_conversation(conn):
+    add_column_if_missing(conn, 'message', 'conversation', 'VARCHAR(161)')
+    conn.execute(text(
+        "UPDATE message SET conversation = CASE WHEN lower(sender) < lower(receiver) "
+        "THEN lower(sender) || ':' || lower(receiver) ELSE lower(receiver) || ':' || lower(sender) END "
+        "WHERE conversation IS NULL AND receiver IS NOT NULL"
+    ))
+
+def migrate_username_key(conn):
+    add_column_if_missing(conn, 'user', 'username_key', 'VARCHAR(80)')
+    conn.execute(text('UPDATE "user" SET username_key = lower(username) WHERE username_key IS NULL'))
+
+def migrate_unique_username_key(conn):
+    # Usernames that differ only in case could register while the index was not unique. The oldest
+    # account keeps the key; the others get "<key>#<id>", which only their exact username finds
+    # (see find_user). Usernames themselves are kept, since messages and notifications refer to them.
+    conn.execute(text(
+        'UPDATE "user" SET username_key = substr(username_key, 1, 60) || \'#\' || CAST(id AS VARCHAR(20)) '
+        'WHERE username_key IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM "user" GROUP BY username_key)'
+    ))
+    conn.execute(text('DROP INDEX IF EXISTS ix_user_username_key'))
+    conn.execute(text('CREATE UNIQUE INDEX ix_user_username_key ON "user" (username_key)'))
+
+def migrate_daily_stats_to_focus_daily(conn):
+    # Moves each user's JSON blob into focus_daily rows, a batch of users at a time
+    last_id = 0
+    while True:
+        users = conn.execute(text(
+            'SELECT id, daily_stats FROM "user" WHERE id > :last_id ORDER BY id LIMIT 500'
+        ), {'last_id': last_id}).all()
+        if not users:
+            break
+        for user_id, daily_stats in users:
+            for date_str, hours in json.loads(daily_stats or '{}').items():
+                conn.execute(increment_focus_daily(conn.dialect.name, user_id, date_str, float(hours)))
+        last_id = users[-1][0]
+    conn.execute(text('''UPDATE "user" SET daily_stats = '{}' '''))
+
+def migrate_habit_weeks(conn):
+    # The legacy string holds the current week; streaks carry over unchanged
+    current_week = week_number()
+    habits = conn.execute(text(
+        "SELECT id, user_id, weekly_completion FROM habit WHERE weekly_completion LIKE '%1%'"
+    )).all()
+    rows = [
+        {'habit_id': habit_id, 'week': current_week, 'user_id': user_id, 'mask': completion_to_mask(completion)}
+        for habit_id, user_id, completion in habits
+    ]
+    if rows:
+        conn.execute(HabitWeek.__table__.insert(), rows)
+
+def migrate_user_search_index(conn):
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_user_username_key_trgm ON "user" USING gin (username_key gin_trgm_ops)'
+        ))
+        return
+    # SQLite: trigram FTS5 index over user.username_key, kept in sync by triggers
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+        "username_key, content='user', content_rowid='id', tokenize='trigram')"
+    ))
+    conn.execute(text('''CREATE TRIGGER IF NOT EXISTS user_search_ai AFTER INSERT ON "user" BEGIN
+        INSERT INTO user_search(rowid, username_key) VALUES (new.id, new.username_key);
+    END'''))
+    conn.execute(text('''CREATE TRIGGER IF NOT EXISTS user_search_ad AFTER DELETE ON "user" BEGIN
+        INSERT INTO user_search(user_search, rowid, username_key) VALUES ('delete', old.id, old.username_key);
+    END'''))
+    conn.execute(text('''CREATE TRIGGER IF NOT EXISTS user_search_au AFTER UPDATE OF username_key ON "user" BEGIN
+        INSERT INTO user_search(user_search, rowid, username_key) VALUES ('delete', old.id, old.username_key);
+        INSERT INTO user_search(rowid, username_key) VALUES (new.id, new.username_key);
+    END'''))
+    conn.execute(text("INSERT INTO user_search(user_search) VALUES ('rebuild')"))
+
+def migrate_notification_count(conn):
+    # Collapse existing unread message notifications into one per (recipient, sender) before the
+    # partial unique index is created
+    add_column_if_missing(conn, 'notification', 'count', 'INTEGER NOT NULL DEFAULT 1')
+    latest = ("SELECT MAX(id) FROM notification WHERE type = 'message' AND NOT read "
+              "GROUP BY user_id, sender_username")
+    conn.execute(text(
+        "UPDATE notification SET count = (SELECT COUNT(*) FROM notification n2 "
+        "WHERE n2.user_id = notification.user_id AND n2.sender_username = notification.sender_username "
+        "AND n2.type = 'message' AND NOT n2.read) "
+        f"WHERE id IN ({latest})"
+    ))
+    conn.execute(text(f"DELETE FROM notification WHERE type = 'message' AND NOT read AND id NOT IN ({latest})"))
+
+def migrate_sync_versions(conn):
+    # Existing rows keep version 0; clients start with a full sync, which does not filter on it
+    add_column_if_missing(conn, 'user', 'sync_version', 'BIGINT NOT NULL DEFAULT 0')
+    for table in ('task', 'event', 'habit', 'notification'):
+        add_column_if_missing(conn, table, 'version', 'BIGINT NOT NULL DEFAULT 0')
+
+def migrate_notification_order(conn):
+    # Superseded by ix_notification_user_timestamp_id, which ensure_indexes() creates
+    conn.execute(text("DROP INDEX IF EXISTS ix_notification_user_id"))
+
+MIGRATIONS = [
+    ('0001_message_conversation', migrate_message_conversation),
+    ('0002_focus_daily', migrate_daily_stats_to_focus_daily),
+    ('0003_username_key', migrate_username_key),
+    ('0004_user_search_index', migrate_user_search_index),
+    ('0005_habit_weeks', migrate_habit_weeks),
+    ('0006_notification_count', migrate_notification_count),
+    ('0007_sync_versions', migrate_sync_versions),
+    ('0008_notification_order', migrate_notification_order),
+    ('0009_unique_username_key', migrate_unique_username_key),
+]
+
+def run_migrations():
+    applied = {m.name for m in SchemaMigration.query.all()}
+    for name, migrate in MIGRATIONS:
+        if name in applied:
+            continue
+        with db.engine.begin() as conn:
+            migrate(conn)
+            conn.execute(SchemaMigration.__table__.insert().values(name=name, applied_at=datetime.utcnow()))
+        print(f"Applied migration {name}")
+
+def ensure_indexes():
+    # create_all() only creates indexes for brand new tables, so add any missing ones explicitly
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+# Socket.IO rooms: every socket joins its user's room so events only reach their recipients
+def user_room(user_id):
+    return f'user:{user_id}'
+
+def conversation_key(user_a, user_b):
+    return ':'.join(sorted([user_a.lower(), user_b.lower()]))
+
+def conversation_room(user_a, user_b):
+    return 'conversation:' + conversation_key(user_a, user_b)
+
+def init_db():
+    # Creates and upgrades the schema. Runs once per deploy (`python app.py migrate`) instead of on
+    # import in every worker; needs an app context.
+    db.create_all()
+    run_migrations()
+    ensure_indexes()
+    # Enable WAL mode for SQLite
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect() as conn:
+            conn.execute(text("PRAGMA journal_mode=WAL"))
+    # Create default user if it doesn't exist
+    if not find_user('Yuvraj'):
+        db.session.add(User(username='Yuvraj'))
+        db.session.commit()
+
+# Scheduled jobs run in one designated process (see start_scheduler); the lease row in job_run
+# still keeps two schedulers from doing the same work if more than one is started
+WORKER_ID = f'{platform.node()}:{os.getpid()}'
+JOB_LEASE_SECONDS = 600
+HABIT_ROLLOVER_CHUNK = 5000
+
+def acquire_job_lease(name):
+    now = datetime.utcnow()
+    db.session.execute(dialect_insert(db.engine.dialect.name, JobRun.__table__).values(name=name).on_conflict_do_nothing())
+    acquired = JobRun.query.filter(
+        JobRun.name == name,
+        db.or_(JobRun.lease_expires_at.is_(None), JobRun.lease_expires_at < now, JobRun.owner == WORKER_ID)
+    ).update({JobRun.owner: WORKER_ID, JobRun.lease_expires_at: now + timedelta(seconds=JOB_LEASE_SECONDS)}, synchronize_session=False)
+    db.session.commit()
+    return acquired == 1
+
+def release_job_lease(name):
+    JobRun.query.filter_by(name=name, owner=WORKER_ID).update({JobRun.lease_expires_at: None}, synchronize_session=False)
+    db.session.commit()
+
+def extend_job_lease(job):
+    job.lease_expires_at = datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)
+
+@contextmanager
+def scheduled_job(name, period):
+    # Yields the job's JobRun row if this worker holds the lease and the job hasn't completed
+    # `period` yet, otherwise None. Records rows and duration once the body finishes.
+    if not acquire_job_lease(name):
+        yield None
+        return
     try:
-        db.create_all()
-        # Enable WAL mode for SQLite
-        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
-            with db.engine.connect() as conn:
-                conn.execute(text("PRAGMA journal_mode=WAL"))
-        # Create default user if it doesn't exist
-        if not User.query.filter(User.username.ilike('Yuvraj')).first():
-            db.session.add(User(username='Yuvraj', daily_stats='{}'))
-            db.session.commit()
-    except Exception as e:
-        print(f"Database initialization error: {e}")
+        job = db.session.get(JobRun, name)
+        if job.period == period and job.completed:
+            yield None
+            return
+        if job.period != period:
+            job.period, job.cursor, job.completed, job.rows = period, 0, False, 0
+        started = time.monotonic()
+        yield job
+        job.completed = True
+        job.duration_ms = int((time.monotonic() - started) * 1000)
+        db.session.commit()
+        print(f"Job {name} {period}: {job.rows} rows in {job.duration_ms}ms")
+    finally:
+        db.session.rollback()
+        release_job_lease(name)
 
 def reset_weekly_habits():
-    with app.app_context():
-        habits = Habit.query.all()
-        for h in habits:
-            if h.weekly_completion == '1111111':
-                h.streak += 1
-            else:
-                h.streak = 0
-            h.weekly_completion = '0000000'
+    with scheduled_job('weekly_habits', datetime.now().strftime('%G-W%V')) as job:
+        if job is None:
+            return
+        # Set-based UPDATEs over id ranges; each chunk commits together with the cursor, so a
+        # run that dies halfway resumes where it stopped instead of advancing streaks twice.
+        # The new week needs no reset: it simply has no HabitWeek rows yet.
+        full_last_week = db.exists().where(
+            HabitWeek.habit_id == Habit.id,
+            HabitWeek.week == week_number() - 1,
+            HabitWeek.mask == FULL_WEEK
+        )
+        max_id = db.session.query(db.func.max(Habit.id)).scalar() or 0
+        while job.cursor < max_id:
+            upper = job.cursor + HABIT_ROLLOVER_CHUNK
+            # Also re-syncs every habit, since its completion now shows the new (empty) week
+            job.rows += update_synced(Habit, {
+                Habit.streak: db.case((full_last_week, Habit.streak + 1), else_=0)
+            }, Habit.id > job.cursor, Habit.id <= upper)
+            job.cursor = upper
+            extend_job_lease(job)
+            db.session.commit()
+
+# Read notifications older than this are deleted by the daily purge job
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 30))
+NOTIFICATION_PURGE_BATCH = 1000
+
+def purge_old_notifications():
+    with scheduled_job('notification_purge', date.today().isoformat()) as job:
+        if job is None:
+            return
+        cutoff = datetime.utcnow() - timedelta(days=NOTIFICATION_RETENTION_DAYS)
+        while True:
+            # Oldest ids first, one short transaction per batch so writers never wait long
+            batch = db.session.scalars(db.select(Notification.id).where(
+                Notification.read.is_(True), Notification.timestamp < cutoff
+            ).order_by(Notification.id).limit(NOTIFICATION_PURGE_BATCH)).all()
+            deleted = delete_synced(Notification, Notification.id.in_(batch)) if batch else 0
+            job.rows += deleted
+            extend_job_lease(job)
+            db.session.commit()
+            if deleted < NOTIFICATION_PURGE_BATCH:
+                break
+
+def purge_old_tombstones():
+    # A cursor older than SYNC_TOMBSTONE_DAYS gets a full sync instead, so tombstones are only read
+    # for that long; one more day is kept as a margin
+    with scheduled_job('tombstone_purge', date.today().isoformat()) as job:
+        if job is None:
+            return
+        cutoff = datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS + 1)
+        while True:
+            batch = db.select(Tombstone.id).where(Tombstone.deleted_at < cutoff).limit(TOMBSTONE_PURGE_BATCH)
+            deleted = Tombstone.query.filter(Tombstone.id.in_(batch)).delete(synchronize_session=False)
+            job.rows += deleted
+            extend_job_lease(job)
+            db.session.commit()
+            if deleted < TOMBSTONE_PURGE_BATCH:
+                break
+
+def start_scheduler(app, blocking=False):
+    # Started by `python app.py scheduler` (blocking) or by a web process with RUN_SCHEDULER=1
+    if blocking:
+        from apscheduler.schedulers.blocking import BlockingScheduler as Scheduler
+    else:
+        from apscheduler.schedulers.background import BackgroundScheduler as Scheduler
+
+    def in_app_context(job):
+        with app.app_context():
+            job()
+
+    scheduler = Scheduler()
+    scheduler.add_job(func=in_app_context, args=[reset_weekly_habits], trigger="cron", day_of_week='mon', hour=0, minute=0)
+    scheduler.add_job(func=in_app_context, args=[purge_old_notifications], trigger="cron", hour=3, minute=0)
+    scheduler.add_job(func=in_app_context, args=[purge_old_tombstones], trigger="cron", hour=3, minute=30)
+    scheduler.start()
+    return scheduler
+
+# Chat write-behind (opt-in with MESSAGE_WRITE_BEHIND=1): handle_message acknowledges and emits
+# right away with a reserved id, and a background task persists messages and their notifications
+# with multi-row INSERTs every MESSAGE_FLUSH_INTERVAL_MS or as soon as MESSAGE_FLUSH_BATCH rows wait.
+# Pending rows are flushed on shutdown; a hard crash can lose at most the rows of one interval.
+MESSAGE_WRITE_BEHIND = os.environ.get('MESSAGE_WRITE_BEHIND', '0') == '1'
+MESSAGE_FLUSH_INTERVAL_MS = int(os.environ.get('MESSAGE_FLUSH_INTERVAL_MS', 20))
+MESSAGE_FLUSH_BATCH = int(os.environ.get('MESSAGE_FLUSH_BATCH', 200))
+
+class MessageIdAllocator:
+    # Hands out message ids without waiting for an INSERT to assign them. Postgres draws each one from
+    # the table's own sequence while the message is handled, so ids follow send order across workers
+    # (history is paged by id) and never collide with regular inserts. SQLite counts up from MAX(id),
+    # which is only safe in a single process; create_app() refuses write-behind on SQLite otherwise.
+    def __init__(self):
+        self._last = None
+        self._lock = threading.Lock()
+
+    def next(self):
+        if db.engine.dialect.name == 'postgresql':
+            return db.session.execute(text("SELECT nextval(pg_get_serial_sequence('message', 'id'))")).scalar_one()
+        with self._lock:
+            if self._last is None:
+                self._last = db.session.query(db.func.max(Message.id)).scalar() or 0
+            self._last += 1
+            return self._last
+
+    def reset(self):
+        # Count up from the table's MAX(id) again, after a collision showed it moved
+        with self._lock:
+            self._last = None
+
+class WriteBehindQueue:
+    def __init__(self, interval_ms, batch_size):
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self._pending = deque()  # (table, row) in arrival order
+        self._flush_lock = threading.Lock()
+        self.app = None
+
+    def start(self, app):
+        if self.app is None:
+            self.app = app
+            socketio.start_background_task(self._run)
+            atexit.register(self.flush)
+
+    def put(self, table, row):
+        self.start(current_app._get_current_object())
+        self._pending.append((table, row))
+        if len(self._pending) >= self.batch_size:
+            socketio.start_background_task(self.flush)
+
+    def pending_messages(self, conversation):
+        return [row for table, row in list(self._pending) if table is Message.__table__ and row['conversation'] == conversation]
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            if self._pending:
+                self.flush()
+
+    def flush(self):
+        if self.app is None:
+            return
+        with self._flush_lock, self.app.app_context():
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Write-behind batch of {len(batch)} rows failed, retrying row by row: {e}")
+                    if not self._write_each(batch):
+                        return
+
+    def _write(self, batch):
+        rows = {}
+        for table, row in batch:
+            rows.setdefault(table, []).append(row)
+        # Messages first so a notification never refers to a message that isn't stored yet
+        if Message.__table__ in rows:
+            db.session.execute(Message.__table__.insert(), rows[Message.__table__])
+        if Notification.__table__ in rows:
+            upsert_message_notifications(rows[Notification.__table__])
         db.session.commit()
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=reset_weekly_habits, trigger="cron", day_of_week='sun', hour=0, minute=0)
-scheduler.start()
+    def _write_each(self, batch):
+        # Isolates the row that broke a batch. Its message was already delivered, so a row the
+        # database rejects is logged and dropped rather than blocking everyone's messages behind it.
+        # Only an unreachable or locked database (OperationalError) puts the rest back for the next tick.
+        for i, (table, row) in enumerate(batch):
+            try:
+                self._write([(table, row)])
+            except OperationalError as e:
+                db.session.rollback()
+                self._pending.extendleft(reversed(batch[i:]))
+                print(f"Write-behind flush failed, {len(self._pending)} rows pending: {e}")
+                return False
+            except Exception as e:
+                db.session.rollback()
+                if isinstance(e, IntegrityError) and table is Message.__table__ and self._store_under_new_id(row):
+                    continue
+                print(f"Write-behind dropped {table.name} row {row!r}: {e}")
+        return True
+
+    def _store_under_new_id(self, row):
+        # The message was already delivered, so a primary key collision must not lose it: unless the
+        # stored row is this same message, it is written again under a fresh id. True when stored.
+        stored = db.session.get(Message, row['id'])
+        if stored is None:
+            return False
+        if (stored.sender, stored.conversation, stored.timestamp, stored.text) == (
+                row['sender'], row['conversation'], row['timestamp'], row['text']):
+            return True
+        message_ids.reset()
+        new_id = message_ids.next()
+        print(f"Write-behind message id {row['id']} was taken, storing it as {new_id}")
+        try:
+            self._write([(Message.__table__, dict(row, id=new_id))])
+        except Exception as e:
+            db.session.rollback()
+            print(f"Write-behind could not store message {row['id']} under a new id: {e}")
+            return False
+        return True
+
+message_ids = MessageIdAllocator()
+write_behind = WriteBehindQueue(MESSAGE_FLUSH_INTERVAL_MS, MESSAGE_FLUSH_BATCH)
+
+# Password hashing is CPU-bound, so it runs on eventlet's native thread pool instead of the hub;
+# hashlib releases the GIL while it works. At most PASSWORD_HASH_CONCURRENCY hashes run at once
+# (default half the cores) so a login storm queues up instead of taking the CPU from everything else.
+# Hashes made with other parameters than PASSWORD_HASH_METHOD are upgraded on the next successful login.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}')
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', max(1, (os.cpu_count() or 1) // 2)))
+password_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_CONCURRENCY)
+
+def run_blocking(fn, *args, **kwargs):
+    # Plain threads already run CPU-bound work next to each other; only the eventlet hub needs help
+    if eventlet_patched():
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+def hash_password(password):
+    with password_hash_slots:
+        return run_blocking(generate_password_hash, password, method=PASSWORD_HASH_METHOD)
+
+def verify_password(pwhash, password):
+    with password_hash_slots:
+        return run_blocking(check_password_hash, pwhash, password)
+
+@functools.cache
+def password_hash_prefix():
+    # Werkzeug stores a method with all its parameters ("scrypt" becomes "scrypt:32768:8:1"), so the
+    # form to compare against comes from one throwaway hash, made on the first login that needs it
+    return hash_password('').split('$', 1)[0]
+
+def password_needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != password_hash_prefix()
 
 # API Routes
 
-@app.route('/api/auth/register', methods=['POST'])
+@bp.route('/api/auth/register', methods=['POST'])
 def register():
     data = request.json
     username = data.get('username')
-    if User.query.filter_by(username=username).first():
+    if find_user(username):
         return jsonify({'status': 'error', 'message': 'Username already exists'}), 400
     
-    hashed_pw = generate_password_hash(data.get('password'), method='pbkdf2:sha256')
+    hashed_pw = hash_password(data.get('password'))
     user = User(
         username=username,
         email=data.get('email'),
-        password=hashed_pw,
-        daily_stats='{}'
+        password=hashed_pw
     )
     try:
         db.session.add(user)
         db.session.commit()
         return jsonify({'status': 'success', 'user': {'username': username}})
+    except IntegrityError:
+        # Lost a race with a concurrent registration of the same name, or the email is taken
+        db.session.rollback()
+        message = 'Username already exists' if find_user(username) else 'Email already registered'
+        return jsonify({'status': 'error', 'message': message}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/api/auth/login', methods=['POST'])
+@bp.route('/api/auth/login', methods=['POST'])
 def login():
     data = request.json
     username_input = data.get('username')
-    user = User.query.filter(User.username.ilike(username_input)).first()
+    user = find_user(username_input)
     
     is_valid_pw = False
     if user:
@@ -216,13 +1188,16 @@ def login():
             is_valid_pw = True
         elif user.password == data.get('password'):
             is_valid_pw = True
-            user.password = generate_password_hash(data.get('password'), method='pbkdf2:sha256')
+            user.password = hash_password(data.get('password'))
             db.session.commit()
         else:
-            is_valid_pw = check_password_hash(user.password, data.get('password'))
+            is_valid_pw = verify_password(user.password, data.get('password'))
+            if is_valid_pw and password_needs_rehash(user.password):
+                user.password = hash_password(data.get('password'))
+                db.session.commit()
 
     if user and is_valid_pw:
-        access_token = create_access_token(identity=user.username)
+        access_token = issue_token(user)
         user_data = {
             'id': user.id,
             'username': user.username,
@@ -236,24 +1211,59 @@ def login():
         })
     return jsonify({'status': 'error', 'message': 'Invalid credentials'}), 401
 
-@app.route('/api/auth/google', methods=['POST'])
+class CachedCertsRequest:
+    # google-auth downloads the signing certs for every token it verifies. This transport keeps
+    # one pooled session and reuses GET responses for as long as their Cache-Control max-age allows.
+    def __init__(self):
+        self._request = None  # google-auth is only imported once someone signs in with Google
+        self._cache = {}  # url -> (expires at, response)
+
+    def __call__(self, url, method='GET', **kwargs):
+        if self._request is None:
+            from google.auth.transport import requests as google_requests
+            self._request = google_requests.Request()
+        if method != 'GET':
+            return self._request(url, method, **kwargs)
+        cached = self._cache.get(url)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        response = self._request(url, method, **kwargs)
+        max_age = re.search(r'max-age=(\d+)', response.headers.get('cache-control', ''))
+        if response.status == 200 and max_age:
+            self._cache[url] = (time.monotonic() + int(max_age.group(1)), response)
+        return response
+
+google_http = CachedCertsRequest()
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+def verify_google_token(token):
+    from google.oauth2 import id_token
+    idinfo = id_token.verify_token(
+        token, google_http, audience=current_app.config['GOOGLE_CLIENT_ID'],
+        certs_url=current_app.config['GOOGLE_CERTS_URL']
+    )
+    if idinfo.get('iss') not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+    return idinfo
+
+@bp.route('/api/auth/google', methods=['POST'])
 def google_auth():
+    from google.auth.exceptions import GoogleAuthError, TransportError
     data = request.json
     token = data.get('credential')
     try:
-        # Verify the Google token
-        CLIENT_ID = "765015665790-79inqu25trcn7i8kmd4dq3n4rsse2j5a.apps.googleusercontent.com"
-        idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), CLIENT_ID)
+        idinfo = verify_google_token(token)
         email = idinfo['email']
         username = email.split('@')[0]
         
         user = User.query.filter(User.email.ilike(email)).first()
         if not user:
-            user = User(username=username, email=email, daily_stats='{}')
+            user = User(username=username, email=email)
             db.session.add(user)
             db.session.commit()
         
-        access_token = create_access_token(identity=user.username)
+        access_token = issue_token(user)
         return jsonify({
             'status': 'success',
             'user': {
@@ -264,60 +1274,99 @@ def google_auth():
                 'token': access_token
             }
         })
-    except ValueError:
+    except TransportError:
+        return jsonify({'status': 'error', 'message': 'Could not reach Google to verify the token'}), 503
+    except (ValueError, PyJWTError, GoogleAuthError):
         return jsonify({'status': 'error', 'message': 'Invalid Google token'}), 401
 
-@app.route('/api/user/profile', methods=['GET'])
+@bp.route('/api/user/profile', methods=['GET'])
 @jwt_required(optional=True)
 def get_profile():
     # Allow fetching other profiles by user param, fallback to jwt identity
     target_user = request.args.get('user') or request.args.get('username')
-    identity = get_jwt_identity()
-    
-    username = target_user or identity
-    if not username:
+    if not target_user and not current_user:
         return jsonify({'status': 'error', 'message': 'No username provided'}), 400
-        
-    user = User.query.filter(User.username.ilike(username)).first()
+
+    if target_user and not (current_user and current_user.username_key == target_user.lower()):
+        user = find_user(target_user)
+    else:
+        user = current_user
     if not user:
          return jsonify({'status': 'error', 'message': 'User not found'}), 404
+    # dailyStats covers the last `days` days (default 30, at most a year) instead of the whole history
+    days = max(1, min(request.args.get('days', 30, type=int), 366))
     return jsonify({
         'username': user.username,
         'level': user.level,
         'xp': user.xp,
         'totalFocusHours': user.total_focus_hours,
-        'dailyStats': user.get_stats(),
+        'dailyStats': user.get_stats(days),
         'profilePic': user.profile_pic,
-        'habitradar': [{'subject': h.title, 'A': (h.weekly_completion.count('1') / 7) * 100} for h in user.habits]
+        'habitradar': [{'subject': title, 'A': done * 100 / 7} for title, done in habit_days_done(user.id)]
     })
 
-@app.route('/api/user/update', methods=['POST'])
+@bp.route('/api/user/update', methods=['POST'])
 @jwt_required()
 def update_profile():
     data = request.json
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).first()
-    if user:
-        if 'profilePic' in data: user.profile_pic = data['profilePic']
-        db.session.commit()
-        return jsonify({'status': 'success'})
-    return jsonify({'status': 'error'}), 404
+    user = current_user
+    if 'profilePic' in data: user.profile_pic = data['profilePic']
+    db.session.commit()
+    return jsonify({'status': 'success'})
 
-@app.route('/api/users/search', methods=['GET'])
+# User search runs against the trigram index from migration 0004: pg_trgm on Postgres,
+# an FTS5 trigram table on SQLite. Queries shorter than a trigram only match prefixes.
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def glob_escape(value):
+    return ''.join(f'[{ch}]' if ch in '*?[' else ch for ch in value)
+
+def username_prefix_filter(q):
+    if db.engine.dialect.name == 'postgresql':
+        return User.username_key.like(like_escape(q) + '%', escape='\\')
+    # GLOB, unlike LIKE, can use the plain username_key index in SQLite
+    return User.username_key.op('GLOB')(glob_escape(q) + '*')
+
+def username_search_filter(q):
+    if len(q) < 3:
+        return username_prefix_filter(q)
+    if db.engine.dialect.name == 'postgresql':
+        return User.username_key.like('%' + like_escape(q) + '%', escape='\\')
+    matches = text('SELECT rowid FROM user_search WHERE username_key GLOB :pattern')
+    return User.id.in_(matches.bindparams(pattern='*' + glob_escape(q) + '*').columns(rowid=db.Integer))
+
+@bp.route('/api/users/search', methods=['GET'])
+@jwt_required(optional=True)
 def search_users():
-    query = request.args.get('q', '')
-    users = User.query.filter(User.username.ilike(f'%{query}%')).limit(10).all()
+    query = request.args.get('q', '').strip().lower()
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    if not query:
+        return jsonify([])
+
+    users = User.query.filter(username_search_filter(query))
+    if current_user:
+        friend_ids = db.select(Friendship.friend_id).where(
+            Friendship.user_id == current_user.id, Friendship.status == 'accepted'
+        )
+        users = users.filter(User.id != current_user.id, User.id.not_in(friend_ids))
+    # Prefix matches first, then shorter (closer) names
+    users = users.order_by(
+        db.case((username_prefix_filter(query), 0), else_=1),
+        db.func.length(User.username_key),
+        User.username_key
+    ).offset(offset).limit(limit).all()
     return jsonify([{'username': u.username, 'id': u.id} for u in users])
 
-@app.route('/api/friends/add', methods=['POST'])
+@bp.route('/api/friends/add', methods=['POST'])
 @jwt_required()
 def add_friend():
     data = request.json
-    me_name = get_jwt_identity()
     target_name = data.get('target')
     
-    me = User.query.filter(User.username.ilike(me_name)).first()
-    target = User.query.filter(User.username.ilike(target_name)).first()
+    me = current_user
+    target = find_user(target_name)
     
     if not target: return jsonify({'status': 'error', 'message': 'User not found'}), 404
     
@@ -335,20 +1384,19 @@ def add_friend():
         'title': 'Friend Request',
         'message': f"{me.username} sent you a friend request!",
         'target_id': target.id
-    })
+    }, to=user_room(target.id))
     return jsonify({'status': 'success'})
 
-@app.route('/api/friends/accept', methods=['POST'])
+@bp.route('/api/friends/accept', methods=['POST'])
 @jwt_required()
 def accept_friend():
     data = request.json
-    me_name = get_jwt_identity()
     sender_name = data.get('sender')
     
-    me = User.query.filter(User.username.ilike(me_name)).first()
-    sender = User.query.filter(User.username.ilike(sender_name)).first()
+    me = current_user
+    sender = find_user(sender_name)
 
-    if not me or not sender:
+    if not sender:
         return jsonify({'status': 'error', 'message': 'User not found'}), 404
 
     existing = Friendship.query.filter_by(user_id=me.id, friend_id=sender.id).first()
@@ -376,37 +1424,32 @@ def accept_friend():
         'title': 'Request Accepted',
         'message': f"{me.username} accepted your friend request!",
         'target_id': sender.id
-    })
+    }, to=user_room(sender.id))
     return jsonify({'status': 'success'})
 
-@app.route('/api/friends', methods=['GET'])
+@bp.route('/api/friends', methods=['GET'])
 @jwt_required()
 def get_friends():
-    username = get_jwt_identity()
-    user = User.query.filter(User.username.ilike(username)).first()
-    if not user: 
-        return jsonify([])
+    user = current_user
     
-    friendships = Friendship.query.filter_by(user_id=user.id, status='accepted').all()
-    friends = []
-    for f in friendships:
-        friend = User.query.get(f.friend_id)
-        if friend:
-            friends.append({
-                'id': str(friend.id),
-                'name': friend.username,
-                'avatar': friend.profile_pic,
-                'level': friend.level,
-                'status': 'online', 
-            })
-    return jsonify(friends)
-
-@app.route('/api/notifications', methods=['GET', 'DELETE'])
+    friends = db.session.execute(
+        db.select(User.id, User.username, User.profile_pic, User.level)
+        .join(Friendship, Friendship.friend_id == User.id)
+        .where(Friendship.user_id == user.id, Friendship.status == 'accepted')
+    ).all()
+    online = presence.online([friend.id for friend in friends])
+    return jsonify([{
+        'id': str(friend.id),
+        'name': friend.username,
+        'avatar': friend.profile_pic,
+        'level': friend.level,
+        'status': 'online' if friend.id in online else 'offline',
+    } for friend in friends])
+
+@bp.route('/api/notifications', methods=['GET', 'DELETE'])
 @jwt_required()
 def handle_notifications():
-    username = get_jwt_identity()
-    user = User.query.filter(User.username.ilike(username)).first()
-    if not user: return jsonify([])
+    user = current_user
 
     if request.method == 'DELETE':
         notif_id = request.args.get('id')
@@ -417,33 +1460,56 @@ def handle_notifications():
             return jsonify({'status': 'success'})
         return jsonify({'status': 'error'}), 404
 
-    notifs = Notification.query.filter_by(user_id=user.id).order_by(Notification.timestamp.desc()).all()
-    return jsonify([{
-        'id': n.id,
-        'title': n.title,
-        'message': n.message,
-        'sender': n.sender_username,
-        'type': n.type,
-        'read': n.read,
-        'time': n.timestamp.strftime('%H:%M')
-    } for n in notifs])
-
-@app.route('/api/notifications/clear', methods=['DELETE'])
+    # Newest first, `limit` at a time; pass the id of the last notification of a page as `before`
+    # for the next one
+    limit = max(1, min(request.args.get('limit', 50, type=int), 100))
+    before = request.args.get('before', type=int)
+    query = Notification.query.filter_by(user_id=user.id)
+    if before:
+        last = db.session.execute(
+            db.select(Notification.timestamp, Notification.id).where(Notification.id == before, Notification.user_id == user.id)
+        ).first()
+        if last:
+            query = query.filter(db.tuple_(Notification.timestamp, Notification.id) < db.tuple_(last.timestamp, last.id))
+        else:
+            query = query.filter(Notification.id < before)
+    notifs = query.order_by(Notification.timestamp.desc(), Notification.id.desc()).limit(limit).all()
+    return jsonify([n.to_dict() for n in notifs])
+
+@bp.route('/api/notifications/unread-count', methods=['GET'])
+@jwt_required()
+def unread_notification_count():
+    count = Notification.query.filter_by(user_id=current_user.id, read=False).count()
+    return jsonify({'count': count})
+
+@bp.route('/api/notifications/read', methods=['POST'])
+@jwt_required()
+def mark_notifications_read():
+    # Marks the given ids as read, or every unread notification when no ids are sent
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    if ids is not None and not (isinstance(ids, list) and all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+        return jsonify({'status': 'error', 'message': 'ids must be a list of integers'}), 400
+    criteria = [Notification.user_id == current_user.id, Notification.read.is_(False)]
+    if ids:
+        criteria.append(Notification.id.in_(ids))
+    updated = update_synced(Notification, {Notification.read: True}, *criteria)
+    db.session.commit()
+    return jsonify({'status': 'success', 'updated': updated})
+
+@bp.route('/api/notifications/clear', methods=['DELETE'])
 @jwt_required()
 def clear_notifications():
-    username = get_jwt_identity()
-    user = User.query.filter(User.username.ilike(username)).first()
-    if not user: return jsonify({'status': 'error'}), 404
+    user = current_user
     
-    Notification.query.filter_by(user_id=user.id).delete()
+    delete_synced(Notification, Notification.user_id == user.id)
     db.session.commit()
     return jsonify({'status': 'success'})
 
-@app.route('/api/notifications/create', methods=['POST'])
+@bp.route('/api/notifications/create', methods=['POST'])
 def create_notification():
     data = request.json
     username = data.get('username')
-    user = User.query.filter(User.username.ilike(username)).first()
+    user = find_user(username)
     if not user:
         return jsonify({'status': 'error', 'message': 'User not found'}), 404
 
@@ -457,12 +1523,24 @@ def create_notification():
     db.session.commit()
     return jsonify({'status': 'success', 'id': notif.id})
 
-@app.route('/api/habits', methods=['GET', 'POST', 'PATCH', 'PUT', 'DELETE'])
+def habits_this_week(*criteria):
+    # (habit, this week's mask or None) pairs
+    return db.session.query(Habit, HabitWeek.mask).outerjoin(
+        HabitWeek, db.and_(HabitWeek.habit_id == Habit.id, HabitWeek.week == week_number())
+    ).filter(*criteria).all()
+
+def habit_to_dict(habit, mask):
+    return {
+        'id': habit.id,
+        'title': habit.title,
+        'completion': mask_to_completion(mask or 0),
+        'streak': habit.streak
+    }
+
+@bp.route('/api/habits', methods=['GET', 'POST', 'PATCH', 'PUT', 'DELETE'])
 @jwt_required()
 def manage_habits():
-    username = get_jwt_identity()
-    user = User.query.filter(User.username.ilike(username)).first()
-    if not user: return jsonify({'error': 'User not found'}), 404
+    user = current_user
 
     if request.method == 'POST':
         data = request.json
@@ -475,9 +1553,19 @@ def manage_habits():
         data = request.json
         habit = Habit.query.get(data['id'])
         if habit and habit.user_id == user.id:
-            habit.weekly_completion = data['completion']
+            if 'day' in data:
+                day, done = data['day'], data.get('done')
+                if not isinstance(day, int) or isinstance(day, bool) or not 0 <= day < 7:
+                    return jsonify({'status': 'error', 'message': 'day must be an integer between 0 and 6'}), 400
+                if done is not None and not isinstance(done, bool):
+                    return jsonify({'status': 'error', 'message': 'done must be true, false or null'}), 400
+                mask = set_habit_day(habit, day, done)
+            else:
+                # Older clients send the whole week
+                mask = set_habit_completion(habit, data['completion'])
+            touch(habit)
             db.session.commit()
-            return jsonify({'status': 'success'})
+            return jsonify({'status': 'success', 'completion': mask_to_completion(mask)})
         return jsonify({'status': 'error'}), 404
 
     if request.method == 'PUT':
@@ -493,44 +1581,63 @@ def manage_habits():
         habit_id = request.args.get('id')
         habit = Habit.query.get(habit_id)
         if habit and habit.user_id == user.id:
+            HabitWeek.query.filter_by(habit_id=habit.id).delete()
             db.session.delete(habit)
             db.session.commit()
             return jsonify({'status': 'success'})
         return jsonify({'error': 'Habit not found'}), 404
 
-    habits = Habit.query.filter_by(user_id=user.id).all()
+    return jsonify([habit_to_dict(h, mask) for h, mask in habits_this_week(Habit.user_id == user.id)])
+
+@bp.route('/api/habits/trends', methods=['GET'])
+@jwt_required()
+def habit_trends():
+    # Share of all habit-days completed in each of the last `weeks` weeks, oldest first
+    weeks = max(1, min(request.args.get('weeks', 8, type=int), 52))
+    current_week = week_number()
+    habit_count = Habit.query.filter_by(user_id=current_user.id).count()
+    totals = dict(db.session.query(HabitWeek.week, db.func.sum(days_done(HabitWeek.mask))).filter(
+        HabitWeek.user_id == current_user.id,
+        HabitWeek.week > current_week - weeks
+    ).group_by(HabitWeek.week).all())
     return jsonify([{
-        'id': h.id,
-        'title': h.title,
-        'completion': h.weekly_completion,
-        'streak': h.streak
-    } for h in habits])
+        'week': week_start(week).isoformat(),
+        'daysDone': int(totals.get(week) or 0),
+        'completion': (totals.get(week) or 0) * 100 / (habit_count * 7) if habit_count else 0
+    } for week in range(current_week - weeks + 1, current_week + 1)])
 
-@app.route('/api/focus/track', methods=['POST'])
+@bp.route('/api/focus/track', methods=['POST'])
 @jwt_required()
 def track_focus():
     data = request.json
     hours = float(data.get('hours', 0))
-    username = get_jwt_identity()
     date_str = datetime.now().strftime('%Y-%m-%d')
-    user = User.query.filter(User.username.ilike(username)).first()
+    user = current_user
     
-    if user:
-        try:
-            user.update_stats(date_str, hours)
-            db.session.commit()
-            return jsonify({'status': 'success', 'total': user.total_focus_hours})
-        except:
-            db.session.rollback()
-            return jsonify({'status': 'error', 'message': 'DB Error'}), 500
-    return jsonify({'status': 'error', 'message': 'User not found'}), 404
+    try:
+        total = user.update_stats(date_str, hours)
+        db.session.commit()
+        return jsonify({'status': 'success', 'total': total})
+    except:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'DB Error'}), 500
+
+def task_to_dict(task):
+    return {
+        'id': task.id,
+        'title': task.title,
+        'description': task.description,
+        'priority': task.priority,
+        'status': task.status,
+        'totalHours': task.total_hours,
+        'hours': task.hours,
+        'subtasks': [{'id': st.id, 'title': st.title, 'completed': st.completed} for st in task.subtasks]
+    }
 
-@app.route('/api/tasks', methods=['GET', 'POST'])
+@bp.route('/api/tasks', methods=['GET', 'POST'])
 @jwt_required()
 def handle_tasks():
-    username = get_jwt_identity()
-    user = User.query.filter(User.username.ilike(username)).first()
-    if not user: return jsonify({'error': 'User not found'}), 404
+    user = current_user
     
     if request.method == 'POST':
         data = request.json
@@ -551,30 +1658,17 @@ def handle_tasks():
             db.session.rollback()
             return jsonify({'status': 'error'}), 500
     
-    tasks = Task.query.filter_by(user_id=user.id).all()
-    output = []
-    for task in tasks:
-        subtasks = SubTask.query.filter_by(task_id=task.id).all()
-        output.append({
-            'id': task.id,
-            'title': task.title,
-            'description': task.description,
-            'priority': task.priority,
-            'status': task.status,
-            'totalHours': task.total_hours,
-            'hours': task.hours,
-            'subtasks': [{'id': st.id, 'title': st.title, 'completed': st.completed} for st in subtasks]
-        })
-    return jsonify(output)
+    # One batched IN query per STREAM_BATCH tasks loads their subtasks, and the board is sent as it is read
+    tasks = Task.query.options(selectinload(Task.subtasks)).filter_by(user_id=user.id).yield_per(STREAM_BATCH)
+    return stream_json_list(tasks, task_to_dict)
 
-@app.route('/api/tasks/<task_id>', methods=['PATCH', 'DELETE'])
+@bp.route('/api/tasks/<task_id>', methods=['PATCH', 'DELETE'])
 @jwt_required()
 def update_task(task_id):
     task = Task.query.get_or_404(task_id)
-    username = get_jwt_identity()
-    user = User.query.filter(User.username.ilike(username)).first()
+    user = current_user
     
-    if not user or task.user_id != user.id:
+    if task.user_id != user.id:
         return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
 
     if request.method == 'DELETE':
@@ -593,38 +1687,78 @@ def update_task(task_id):
         old_status = task.status
         task.status = data['status']
         if task.status == 'completed' and old_status != 'completed':
-            level_up = add_xp(user, 150)
+            level, xp, level_up = add_xp(user.id, 150)
             db.session.commit()
             
             socketio.emit('xp_gain', {
                 'amount': 150,
-                'new_xp': user.xp,
-                'level': user.level,
+                'new_xp': xp,
+                'level': level,
                 'level_up': level_up
-            })
+            }, to=user_room(user.id))
             
             socketio.emit('notification', {
                 'title': 'Mission Accomplished!',
                 'message': f'You earned 150 XP for completing "{task.title}"',
                 'type': 'success',
                 'target_id': user.id
-            })
+            }, to=user_room(user.id))
 
     if 'subtasks' in data:
-        SubTask.query.filter_by(task_id=task_id).delete()
+        # Diff against the stored list so ticking one box is one UPDATE, not a delete and re-insert of all
+        stored = {st.id: st for st in task.subtasks}
         for st_data in data['subtasks']:
-            st = SubTask(id=st_data['id'], task_id=task_id, title=st_data['title'], completed=st_data['completed'])
-            db.session.add(st)
+            st = stored.pop(st_data['id'], None)
+            if st is None:
+                db.session.add(SubTask(id=st_data['id'], task_id=task_id, title=st_data['title'], completed=st_data['completed']))
+            else:
+                # Assigning an unchanged value does not make the row dirty
+                st.title = st_data['title']
+                st.completed = st_data['completed']
+        for st in stored.values():
+            db.session.delete(st)
     
     db.session.commit()
     return jsonify({'status': 'success'})
 
-@app.route('/api/events', methods=['GET', 'POST', 'DELETE'])
+@bp.route('/api/tasks/<task_id>/subtasks/<subtask_id>', methods=['PATCH'])
+@jwt_required()
+def update_subtask(task_id, subtask_id):
+    # Sets `completed` and/or `title` of one subtask; without `completed` it is toggled
+    task = Task.query.get_or_404(task_id)
+    if task.user_id != current_user.id:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('completed', False), bool) or not isinstance(data.get('title', ''), str):
+        return jsonify({'status': 'error', 'message': 'completed must be a boolean and title a string'}), 400
+    values = {SubTask.completed: data['completed'] if 'completed' in data else db.not_(SubTask.completed)}
+    if 'title' in data:
+        values[SubTask.title] = data['title']
+    completed = db.session.execute(
+        db.update(SubTask).where(SubTask.id == subtask_id, SubTask.task_id == task.id)
+        .values(values).returning(SubTask.completed)
+    ).scalar()
+    if completed is None:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Subtask not found'}), 404
+    touch(task)
+    db.session.commit()
+    return jsonify({'status': 'success', 'completed': completed})
+
+def event_to_dict(event):
+    return {
+        'id': event.id,
+        'title': event.title,
+        'date': event.date,
+        'time': event.time,
+        'category': event.category
+    }
+
+@bp.route('/api/events', methods=['GET', 'POST', 'DELETE'])
 @jwt_required()
 def manage_events():
-    username = get_jwt_identity()
-    user = User.query.filter(User.username.ilike(username)).first()
-    if not user: return jsonify([])
+    user = current_user
 
     if request.method == 'POST':
         data = request.json
@@ -649,95 +1783,831 @@ def manage_events():
             return jsonify({'status': 'success'})
         return jsonify({'status': 'error'}), 404
 
-    events = Event.query.filter_by(user_id=user.id).all()
-    return jsonify([{
-        'id': e.id,
-        'title': e.title,
-        'date': e.date,
-        'time': e.time,
-        'category': e.category
-    } for e in events])
-
-@socketio.on('connect')
-def handle_connect(auth=None):
-    print(f"Client connected: {request.sid}")
+    events = Event.query.filter_by(user_id=user.id).yield_per(STREAM_BATCH)
+    return stream_json_list(events, event_to_dict)
+
+# /api/batch: an offline queue of task, subtask and event edits in one request and one transaction.
+# Operations are checked against the rows as they will be after the operations before them, then
+# the net effect is written with one bulk DELETE, INSERT and UPDATE per table.
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 500))
+# JSON key -> column each operation may set; creates start from the defaults
+BATCH_TYPES = {
+    'task': (Task, {'title': 'title', 'description': 'description', 'priority': 'priority', 'status': 'status', 'totalHours': 'total_hours'}),
+    'subtask': (SubTask, {'title': 'title', 'completed': 'completed'}),
+    'event': (Event, {'title': 'title', 'date': 'date', 'time': 'time', 'category': 'category'}),
+}
+BATCH_DEFAULTS = {
+    'task': {'description': '', 'priority': 'normal', 'total_hours': 1, 'hours': 0},
+    'subtask': {'completed': False},
+    'event': {'category': 'general'},
+}
+BATCH_REQUIRED = {'task': ('title',), 'subtask': ('taskId', 'title'), 'event': ('title', 'date', 'time')}
+
+def batch_values(kind, data):
+    # (column values, None) for the keys present in data, or (None, error message)
+    model, fields = BATCH_TYPES[kind]
+    values = {}
+    for key, name in fields.items():
+        if key not in data:
+            continue
+        value, column = data[key], model.__table__.c[name]
+        python_type = column.type.python_type
+        if value is None and column.nullable:
+            pass
+        elif not isinstance(value, python_type) or (python_type is int and isinstance(value, bool)):
+            return None, f"{key} must be of type {python_type.__name__}"
+        elif python_type is str and column.type.length and len(value) > column.type.length:
+            return None, f"{key} is longer than {column.type.length} characters"
+        values[name] = value
+    return values, None
+
+@bp.route('/api/batch', methods=['POST'])
+@jwt_required()
+def apply_batch():
+    user = current_user
+    operations = (request.json or {}).get('operations')
+    if not isinstance(operations, list):
+        return jsonify({'status': 'error', 'message': 'operations must be a list'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'status': 'error', 'message': f'At most {BATCH_MAX_OPERATIONS} operations per batch'}), 413
+
+    # One query per table loads every row the batch refers to, with its owner
+    ids = {kind: set() for kind in BATCH_TYPES}
+    for op in operations:
+        if isinstance(op, dict) and isinstance(op.get('type'), str) and op['type'] in ids and isinstance(op.get('id'), str):
+            ids[op['type']].add(op['id'])
+            if op['type'] == 'subtask' and isinstance(op.get('taskId'), str):
+                ids['task'].add(op['taskId'])
+    owners, task_of, tasks = {kind: {} for kind in BATCH_TYPES}, {}, {}
+    for task_id, owner, title, status in db.session.execute(
+        db.select(Task.id, Task.user_id, Task.title, Task.status).where(Task.id.in_(ids['task']))
+    ):
+        owners['task'][task_id] = owner
+        tasks[task_id] = {'title': title, 'status': status}
+    for event_id, owner in db.session.execute(db.select(Event.id, Event.user_id).where(Event.id.in_(ids['event']))):
+        owners['event'][event_id] = owner
+    for subtask_id, task_id, owner in db.session.execute(
+        db.select(SubTask.id, SubTask.task_id, Task.user_id).join(Task, Task.id == SubTask.task_id).where(SubTask.id.in_(ids['subtask']))
+    ):
+        owners['subtask'][subtask_id] = owner
+        task_of[subtask_id] = task_id
+
+    # Replay the operations on what is known about those rows; only the net effect is written
+    exists = {kind: {row_id for row_id, owner in owners[kind].items() if owner == user.id} for kind in BATCH_TYPES}
+    created = {kind: {} for kind in BATCH_TYPES}  # id -> full row to insert
+    updated = {kind: {} for kind in BATCH_TYPES}  # id -> changed columns of a stored row
+    deleted = {kind: set() for kind in BATCH_TYPES}  # stored ids to delete
+    completed = []  # titles of tasks that became completed
+    results = []
+
+    def remove(kind, row_id):
+        exists[kind].discard(row_id)
+        updated[kind].pop(row_id, None)
+        created[kind].pop(row_id, None)
+        if row_id in owners[kind]:
+            deleted[kind].add(row_id)
+
+    for op in operations:
+        if (not isinstance(op, dict) or not isinstance(op.get('type'), str) or not isinstance(op.get('op'), str)
+                or op['type'] not in BATCH_TYPES or op['op'] not in ('create', 'update', 'delete')):
+            results.append({'status': 'error', 'message': 'Unknown operation'})
+            continue
+        kind, row_id = op['type'], op.get('id')
+        if not isinstance(row_id, str) or not 0 < len(row_id) <= 36:
+            results.append({'status': 'error', 'message': 'id must be a string of up to 36 characters'})
+            continue
+        task_id = op.get('taskId')
+        if task_id is not None and not (isinstance(task_id, str) and 0 < len(task_id) <= 36):
+            results.append({'status': 'error', 'message': 'taskId must be a string of up to 36 characters'})
+            continue
+        if row_id in owners[kind] and owners[kind][row_id] != user.id:
+            results.append({'status': 'error', 'message': 'Unauthorized'})
+            continue
+
+        if op['op'] == 'create':
+            missing = [key for key in BATCH_REQUIRED[kind] if op.get(key) is None]
+            values, error = batch_values(kind, op)
+            if row_id in exists[kind]:
+                error = 'Already exists'
+            elif missing:
+                error = f"Missing {', '.join(missing)}"
+            elif kind == 'subtask' and op['taskId'] not in exists['task']:
+                error = 'Task not found'
+            if error:
+                results.append({'status': 'error', 'message': error})
+                continue
+            row = dict(BATCH_DEFAULTS[kind], **values, id=row_id)
+            if kind == 'task':
+                row['status'] = 'todo'
+                tasks[row_id] = {'title': row['title'], 'status': 'todo'}
+            if kind == 'subtask':
+                row['task_id'] = task_of[row_id] = op['taskId']
+            else:
+                row['user_id'] = user.id
+            created[kind][row_id] = row
+            exists[kind].add(row_id)
+
+        elif op['op'] == 'update':
+            values, error = batch_values(kind, op)
+            if row_id not in exists[kind]:
+                error = 'Not found'
+            if error:
+                results.append({'status': 'error', 'message': error})
+                continue
+            if kind == 'task':
+                if values.get('status') == 'completed' and tasks[row_id]['status'] != 'completed':
+                    completed.append(values.get('title', tasks[row_id]['title']))
+                tasks[row_id].update({k: v for k, v in values.items() if k in ('title', 'status')})
+            (created[kind][row_id] if row_id in created[kind] else updated[kind].setdefault(row_id, {})).update(values)
+
+        else:
+            if row_id not in exists[kind]:
+                results.append({'status': 'error', 'message': 'Not found'})
+                continue
+            remove(kind, row_id)
+            if kind == 'task':
+                # Stored subtasks go with the bulk delete by task_id below
+                for subtask_id in [s for s in exists['subtask'] if task_of.get(s) == row_id]:
+                    remove('subtask', subtask_id)
+        results.append({'status': 'success'})
+
+    if any(created[kind] or updated[kind] or deleted[kind] for kind in BATCH_TYPES):
+        version = bump_sync_versions([user.id])[user.id]
+        # Tasks whose subtasks changed are re-synced as a whole
+        changed_tasks = {task_of[s] for s in set(created['subtask']) | set(updated['subtask']) | deleted['subtask']}
+        try:
+            if deleted['subtask']:
+                db.session.execute(db.delete(SubTask).where(SubTask.id.in_(deleted['subtask'])))
+            if deleted['task']:
+                db.session.execute(db.delete(SubTask).where(SubTask.task_id.in_(deleted['task'])))
+            for kind, model in (('task', Task), ('event', Event)):
+                if deleted[kind]:
+                    db.session.execute(db.delete(model).where(model.id.in_(deleted[kind])))
+                    db.session.execute(Tombstone.__table__.insert(), [
+                        {'user_id': user.id, 'collection': SYNC_COLLECTIONS[model], 'row_id': row_id,
+                         'version': version, 'deleted_at': datetime.utcnow()}
+                        for row_id in deleted[kind]
+                    ])
+            for kind, model in (('task', Task), ('subtask', SubTask), ('event', Event)):
+                if created[kind]:
+                    rows = list(created[kind].values())
+                    if kind != 'subtask':
+                        rows = [dict(row, version=version) for row in rows]
+                    db.session.execute(db.insert(model), rows)
+            for task_id in changed_tasks - set(created['task']) - deleted['task']:
+                updated['task'].setdefault(task_id, {})
+            for kind, model in (('task', Task), ('subtask', SubTask), ('event', Event)):
+                if updated[kind]:
+                    rows = [dict(values, id=row_id) for row_id, values in updated[kind].items()]
+                    if kind != 'subtask':
+                        rows = [dict(row, version=version) for row in rows]
+                    db.session.execute(db.update(model), rows)
+            if completed:
+                level, xp, level_up = add_xp(user.id, 150 * len(completed))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Batch of {len(operations)} operations failed: {e}")
+            return jsonify({'status': 'error', 'message': 'Batch could not be applied'}), 500
+
+        if completed:
+            socketio.emit('xp_gain', {
+                'amount': 150 * len(completed),
+                'new_xp': xp,
+                'level': level,
+                'level_up': level_up
+            }, to=user_room(user.id))
+            for title in completed:
+                socketio.emit('notification', {
+                    'title': 'Mission Accomplished!',
+                    'message': f'You earned 150 XP for completing "{title}"',
+                    'type': 'success',
+                    'target_id': user.id
+                }, to=user_room(user.id))
+
+    return jsonify({'status': 'success', 'results': results})
+
+@bp.route('/api/sync', methods=['GET'])
+@jwt_required()
+def sync():
+    # Rows changed since `since` (the cursor of an earlier response) in every collection, with the
+    # ids deleted since then; clients apply `deleted` first, then the rows. Without a cursor, or with
+    # one older than the tombstones we keep, the full collections come back with reset=true and
+    # replace the client's copy (notifications: the newest page, /api/notifications has the rest).
+    user_id = current_user.id
+    since = request.args.get('since', '')
+    try:
+        since_version, issued = (int(part) for part in since.split('.')) if since else (0, 0)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+
+    # Read before the rows: everything up to this version is committed. Rows stamped later may be
+    # included too and simply come again with the next sync.
+    version = db.session.scalar(db.select(User.sync_version).where(User.id == user_id))
+    reset = not since or since_version > version or issued < time.time() - SYNC_TOMBSTONE_DAYS * 86400
+
+    def changed(model):
+        criteria = [model.user_id == user_id]
+        if not reset:
+            criteria.append(model.version > since_version)
+        return criteria
+
+    notifications = Notification.query.filter(*changed(Notification)).order_by(Notification.timestamp.desc(), Notification.id.desc())
+    if reset:
+        notifications = notifications.limit(100)
+    deleted = {collection: [] for collection in SYNC_COLLECTIONS.values()}
+    if not reset:
+        tombstones = db.session.query(Tombstone.collection, Tombstone.row_id).filter(
+            Tombstone.user_id == user_id, Tombstone.version > since_version
+        )
+        for collection, row_id in tombstones:
+            deleted[collection].append(int(row_id) if collection in ('habits', 'notifications') else row_id)
+
+    return jsonify({
+        'status': 'success',
+        'cursor': f"{version}.{int(time.time())}",
+        'reset': reset,
+        'tasks': [task_to_dict(t) for t in Task.query.options(selectinload(Task.subtasks)).filter(*changed(Task))],
+        'events': [event_to_dict(e) for e in Event.query.filter(*changed(Event))],
+        'habits': [habit_to_dict(h, mask) for h, mask in habits_this_week(*changed(Habit))],
+        'notifications': [n.to_dict() for n in notifications],
+        'deleted': deleted
+    })
 
-@socketio.on('disconnect')
+# Presence: open sockets per online user in this worker. Offline users have no entry, so memory
+# follows the number of connected users (tens of thousands are a few MB). Friends are told when a
+# user's first socket connects and when the last one goes away, through the message queue if any.
+# With several workers on a Redis message queue, each worker also records in Redis which users it
+# holds sockets for: a sorted set per user of worker ids, scored by when the entry expires. Live
+# workers refresh their entries every PRESENCE_TTL/3 seconds, so a crashed worker's users drop out.
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 60))
+
+class PresenceRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sockets = {}
+        self.redis = None  # set by share() in multi-worker mode
+        self.worker_id = None  # taken in the worker on its first socket, after any fork
+
+    def share(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    def connect(self, user_id):
+        # True when this is the user's first socket on any worker
+        with self.lock:
+            self.sockets[user_id] = self.sockets.get(user_id, 0) + 1
+            if self.sockets[user_id] > 1:
+                return False
+        if self.redis is None:
+            return True
+        self.start_refresh()
+        return self._shared(user_id, True) == 1
+
+    def disconnect(self, user_id):
+        # True when this was the user's last socket on any worker
+        with self.lock:
+            count = self.sockets.get(user_id, 0) - 1
+            if count > 0:
+                self.sockets[user_id] = count
+                return False
+            if self.sockets.pop(user_id, None) is None:
+                return False
+        if self.redis is None:
+            return True
+        return self._shared(user_id, False) == 0
+
+    def online(self, user_ids):
+        # The subset of user_ids with a socket on any worker
+        if self.redis is None:
+            return {user_id for user_id in user_ids if user_id in self.sockets}
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.zcount(presence_key(user_id), time.time(), '+inf')
+            return {user_id for user_id, workers in zip(user_ids, pipe.execute()) if workers}
+        except Exception as e:
+            print(f"Presence lookup failed, answering for this worker only: {e}")
+            return {user_id for user_id in user_ids if user_id in self.sockets}
+
+    def is_online(self, user_id):
+        return user_id in self.online([user_id])
+
+    def _shared(self, user_id, connected):
+        # Adds or removes this worker for the user; returns how many live workers hold the user's sockets
+        key, now = presence_key(user_id), time.time()
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zremrangebyscore(key, '-inf', now)
+            if connected:
+                pipe.zadd(key, {self.worker_id: now + PRESENCE_TTL})
+                pipe.expire(key, PRESENCE_TTL)
+            else:
+                pipe.zrem(key, self.worker_id)
+            pipe.zcard(key)
+            return pipe.execute()[-1]
+        except Exception as e:
+            print(f"Presence update failed for user {user_id}: {e}")
+            return int(connected)
+
+    def start_refresh(self):
+        if self.worker_id is None:
+            self.worker_id = f'{platform.node()}:{os.getpid()}'
+            socketio.start_background_task(self._refresh)
+            atexit.register(self._forget_worker)
+
+    def _refresh(self):
+        while True:
+            socketio.sleep(PRESENCE_TTL / 3)
+            deadline = time.time() + PRESENCE_TTL
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for user_id in list(self.sockets):
+                    pipe.zadd(presence_key(user_id), {self.worker_id: deadline})
+                    pipe.expire(presence_key(user_id), PRESENCE_TTL)
+                pipe.execute()
+            except Exception as e:
+                print(f"Presence refresh failed: {e}")
+
+    def _forget_worker(self):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in list(self.sockets):
+                pipe.zrem(presence_key(user_id), self.worker_id)
+            pipe.execute()
+        except Exception as e:
+            print(f"Presence cleanup failed: {e}")
+
+def presence_key(user_id):
+    return f'presence:{user_id}'
+
+presence = PresenceRegistry()
+
+def push_presence(user_id, status):
+    friend_ids = db.session.scalars(
+        db.select(Friendship.friend_id).where(Friendship.user_id == user_id, Friendship.status == 'accepted')
+    ).all()
+    if friend_ids:
+        socketio.emit('presence', {'id': str(user_id), 'status': status}, to=[user_room(f) for f in friend_ids])
+
+@socket_event('connect')
+def handle_connect(auth=None):
+    token = (auth or {}).get('token') or request.args.get('token')
+    try:
+        claims = decode_token(token)
+    except Exception:
+        print(f"Rejected unauthenticated socket: {request.sid}")
+        return False
+    user = user_from_claims(claims)
+    if not user:
+        return False
+    session['user_id'] = user.id
+    session['username'] = user.username
+    join_room(user_room(user.id))
+    if presence.connect(user.id):
+        push_presence(user.id, 'online')
+    print(f"Client connected: {request.sid} ({user.username})")
+
+@socket_event('disconnect')
 def handle_disconnect(reason=None):
+    if 'user_id' in session and presence.disconnect(session['user_id']):
+        push_presence(session['user_id'], 'offline')
     print(f"Client disconnected: {request.sid} (Reason: {reason})")
 
-@socketio.on('message')
+@socket_event('join_conversation')
+def handle_join_conversation(data):
+    friend = (data or {}).get('with')
+    if friend and session.get('username'):
+        join_room(conversation_room(session['username'], friend))
+
+@socket_event('leave_conversation')
+def handle_leave_conversation(data):
+    friend = (data or {}).get('with')
+    if friend and session.get('username'):
+        leave_room(conversation_room(session['username'], friend))
+
+@socket_event('message')
 def handle_message(data):
-    sender = data.get('sender')
+    # The sender is whoever authenticated this socket, not whatever the payload claims
+    sender = session.get('username')
+    data = data if isinstance(data, dict) else {}
     receiver = data.get('receiver')
     text = data.get('text')
     
-    if not sender or not text:
+    # Checked before the message is acknowledged: write-behind cannot report a row the database rejects
+    if not sender or not text or not isinstance(text, str):
+        return
+    if receiver is not None and not (isinstance(receiver, str) and len(receiver) <= 80):
         return
     
-    msg = Message(text=text, sender=sender, receiver=receiver)
-    db.session.add(msg)
-    db.session.commit()
-    
-    message_data = {
-        'id': msg.id,
-        'text': msg.text,
+    row = {
+        'text': text,
         'sender': sender,
         'receiver': receiver,
-        'timestamp': msg.timestamp.isoformat()
+        'conversation': conversation_key(sender, receiver) if receiver else None,
+        'timestamp': datetime.utcnow()
+    }
+    rec_user_id = lookup_user_id(receiver) if receiver else None
+    notif_row = {
+        'user_id': rec_user_id,
+        'sender_username': sender,
+        'title': "New Message",
+        'message': f"You received a new message from {sender}",
+        'type': "message",
+        'read': False,
+        'timestamp': row['timestamp']
     }
-    socketio.emit('new_message', message_data)
-    
-    if receiver:
-        rec_user = User.query.filter(User.username.ilike(receiver)).first()
-        if rec_user:
-            notif = Notification(
-                user_id=rec_user.id,
-                sender_username=sender,
-                title="New Message",
-                message=f"You received a new message from {sender}",
-                type="message"
-            )
-            db.session.add(notif)
-            db.session.commit()
 
-@app.route('/api/messages', methods=['GET'])
+    if MESSAGE_WRITE_BEHIND:
+        row['id'] = message_ids.next()
+        write_behind.put(Message.__table__, row)
+        if rec_user_id:
+            write_behind.put(Notification.__table__, notif_row)
+    else:
+        msg = Message(**row)
+        db.session.add(msg)
+        if rec_user_id:
+            upsert_message_notifications([notif_row])
+        db.session.commit()
+        row['id'] = msg.id
+
+    message_data = message_to_dict(row)
+    if not rec_user_id:
+        socketio.emit('new_message', message_data, to=user_room(session['user_id']))
+        return
+
+    # Open chat windows on either side get it through the conversation room,
+    # the receiver's other screens through their user room (sids are de-duplicated)
+    socketio.emit('new_message', message_data, to=[conversation_room(sender, receiver), user_room(rec_user_id)])
+    push_message_notification(rec_user_id, sender)
+
+# A burst of messages from one sender refreshes the recipient's notification list once per window
+NOTIFICATION_PUSH_DEBOUNCE = float(os.environ.get('NOTIFICATION_PUSH_DEBOUNCE', 2))
+_pushes_due = set()  # (recipient id, sender) with a push already scheduled
+
+def push_message_notification(user_id, sender):
+    key = (user_id, sender)
+    if key in _pushes_due:
+        return
+    _pushes_due.add(key)
+
+    def push():
+        socketio.sleep(NOTIFICATION_PUSH_DEBOUNCE)
+        _pushes_due.discard(key)
+        socketio.emit('notification', {
+            'title': 'New Message',
+            'message': f"You received new messages from {sender}",
+            'type': 'message',
+            'target_id': user_id
+        }, to=user_room(user_id))
+
+    socketio.start_background_task(push)
+
+_user_ids = {}  # lowercased username -> id; usernames never change, so hits never go stale
+
+def lookup_user_id(username):
+    key = username.lower()
+    if key not in _user_ids:
+        user = find_user(key)
+        if not user:
+            return None
+        if len(_user_ids) >= 10000:
+            _user_ids.clear()
+        _user_ids[key] = user.id
+    return _user_ids[key]
+
+def message_to_dict(m):
+    if not isinstance(m, dict):
+        m = {'id': m.id, 'text': m.text, 'sender': m.sender, 'receiver': m.receiver, 'timestamp': m.timestamp}
+    return {
+        'id': m['id'],
+        'text': m['text'],
+        'sender': m['sender'],
+        'receiver': m['receiver'],
+        'timestamp': m['timestamp'].isoformat()
+    }
+
+@bp.route('/api/messages', methods=['GET'])
 @jwt_required()
 def get_messages():
-    user1 = get_jwt_identity()
+    user1 = current_user.username
     user2 = request.args.get('user2')
     
     if not user1 or not user2:
         return jsonify([])
     
-    messages = Message.query.filter(
-        db.or_(
-            db.and_(Message.sender == user1, Message.receiver == user2),
-            db.and_(Message.sender == user2, Message.receiver == user1)
-        )
-    ).order_by(Message.timestamp.asc()).all()
-    
-    return jsonify([{
-        'id': m.id,
-        'text': m.text,
-        'sender': m.sender,
-        'receiver': m.receiver,
-        'timestamp': m.timestamp.isoformat()
-    } for m in messages])
+    # Keyset pagination: the newest `limit` messages older than `before`, returned oldest first.
+    # Pass the smallest id of a page as `before` to fetch the page preceding it.
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    before = request.args.get('before', type=int)
+
+    conversation = conversation_key(user1, user2)
+    query = Message.query.filter(Message.conversation == conversation)
+    if before:
+        query = query.filter(Message.id < before)
+    messages = [message_to_dict(m) for m in query.order_by(Message.id.desc()).limit(limit)]
+
+    if MESSAGE_WRITE_BEHIND:
+        # Include messages that were acknowledged but not flushed yet
+        stored = {m['id'] for m in messages}
+        pending = [
+            message_to_dict(row) for row in write_behind.pending_messages(conversation)
+            if row['id'] not in stored and (not before or row['id'] < before)
+        ]
+        messages = sorted(messages + pending, key=lambda m: m['id'], reverse=True)[:limit]
+
+    messages.reverse()
+    return jsonify(messages)
+
+# Frontend files are read once per worker, with their ETags and compressed variants: create_app() starts
+# that in the background and requests that arrive first wait for it. Files Vite fingerprinted, as listed
+# in its build manifest (build.manifest in vite.config.ts), never change content and cache forever.
+# Everything else, including files copied from public/, is revalidated with its ETag.
+VITE_MANIFESTS = ('.vite/manifest.json', 'manifest.json')  # Vite 5, Vite 4
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/manifest+json', 'image/svg+xml')
+COMPRESS_MIN_SIZE = 1024
+
+def compress_variants(body, path):
+    # Prefer .br/.gz files shipped next to the original, otherwise compress in memory
+    variants = {}
+    for encoding, suffix, compress in (
+        ('br', '.br', brotli and (lambda data: brotli.compress(data, quality=9))),
+        ('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))
+    ):
+        if os.path.isfile(path + suffix):
+            with open(path + suffix, 'rb') as f:
+                variants[encoding] = f.read()
+        elif compress:
+            compressed = compress(body)
+            if len(compressed) < len(body) * 0.9:
+                variants[encoding] = compressed
+    return variants
+
+def fingerprinted_files(root):
+    for name in VITE_MANIFESTS:
+        path = os.path.join(root, name)
+        if os.path.isfile(path):
+            with open(path) as f:
+                chunks = json.load(f).values()
+            return {file for chunk in chunks for file in [chunk['file'], *chunk.get('css', ()), *chunk.get('assets', ())]}
+    return set()
+
+def build_static_manifest(root):
+    manifest = {}
+    immutable = fingerprinted_files(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root and '.vite' in dirnames:
+            dirnames.remove('.vite')  # build metadata, not served
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith(('.br', '.gz')) and os.path.isfile(path[:-3]):
+                continue
+            with open(path, 'rb') as f:
+                body = f.read()
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            etag = hashlib.sha1(body).hexdigest()[:20]
+            variants = {None: (body, etag)}
+            if len(body) >= COMPRESS_MIN_SIZE and mimetype.startswith(COMPRESSIBLE_TYPES):
+                for encoding, data in compress_variants(body, path).items():
+                    variants[encoding] = (data, f"{etag}-{encoding}")
+            manifest[name] = {
+                'mimetype': mimetype,
+                'immutable': name in immutable,
+                'variants': variants
+            }
+    return manifest
+
+_static_files_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def _static_files():
+    # Reading and brotli-compressing dist/ is CPU-bound, so it runs off the eventlet hub
+    return run_blocking(build_static_manifest, dist_dir) if os.path.isdir(dist_dir) else {}
+
+def static_files():
+    with _static_files_lock:
+        return _static_files()
 
 # Serve Frontend - Catch-all route should be last
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
+@bp.route('/', defaults={'path': ''})
+@bp.route('/<path:path>')
 def serve(path):
-    if path != "" and os.path.exists(os.path.join(app.static_folder, path)):
-        return send_from_directory(app.static_folder, path)
+    # Unknown paths are client-side routes and get index.html
+    static_file = static_files().get(path) or static_files().get('index.html')
+    if not static_file:
+        return f"Static folder: {dist_dir} exists: {os.path.exists(dist_dir)}. index.html not found.", 404
+
+    variants = static_file['variants']
+    encoding = next((e for e in ('br', 'gzip') if e in variants and request.accept_encodings[e]), None)
+    body, etag = variants[encoding]
+
+    response = current_app.response_class(body, mimetype=static_file['mimetype'])
+    response.set_etag(etag)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if len(variants) > 1:
+        response.vary.add('Accept-Encoding')
+    if static_file['immutable']:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
     else:
-        # Check if index.html exists, if not return a custom message
-        if os.path.exists(os.path.join(app.static_folder, 'index.html')):
-            return send_from_directory(app.static_folder, 'index.html')
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+# API responses: JSON is encoded with orjson when it is installed, clients that send
+# Accept: application/msgpack get MessagePack when msgpack is installed, and bodies are compressed
+# with br or gzip as the client accepts. Long lists are streamed as they are read from the database.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', '1') == '1'
+RESPONSE_COMPRESS_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESS_MIN_SIZE', 1024))
+# Per-request compression has to be cheap, unlike the static files which are compressed once
+RESPONSE_BROTLI_QUALITY = 4
+RESPONSE_GZIP_LEVEL = 6
+STREAM_BATCH = 200
+
+def wants_msgpack():
+    if msgpack is None or not has_request_context():
+        return False
+    return request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES
+
+class FastJSONProvider(DefaultJSONProvider):
+    # Dates, decimals and the like still go through the default provider's hook, so output matches it
+    def __init__(self, app):
+        super().__init__(app)
+        self.orjson = orjson if app.config['JSON_PROVIDER'] == 'orjson' else None
+
+    def dumps(self, obj, **kwargs):
+        if self.orjson is None or set(kwargs) - {'separators'}:
+            return super().dumps(obj, **kwargs)
+        return self.encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        if self.orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return self.orjson.loads(s)
+
+    def encode(self, obj):
+        return self.orjson.dumps(
+            obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+
+    def response(self, *args, **kwargs):
+        if wants_msgpack():
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(msgpack.packb(obj, default=self.default), mimetype=MSGPACK_MIMETYPES[0])
+        elif self.orjson is None or self._app.debug:
+            response = super().response(*args, **kwargs)
         else:
-            return f"Static folder: {app.static_folder} exists: {os.path.exists(app.static_folder)}. index.html not found.", 404
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(self.encode(obj), mimetype=self.mimetype)
+        if msgpack is not None:
+            response.vary.add('Accept')
+        return response
+
+def stream_json_list(query, to_dict):
+    # A JSON array written STREAM_BATCH rows at a time while the query is read, so the whole
+    # result never sits in memory as objects plus one big string. Short lists are sent in one piece.
+    if wants_msgpack():
+        return jsonify([to_dict(row) for row in query])
+    # The query runs once: the first STREAM_BATCH + 1 rows decide whether to stream, are sent first,
+    # and the same result continues after them. It gets a session of its own because the view's
+    # session is removed when the view returns; that one is closed when the response is.
+    session, streaming = Session(db.engine), False
+    try:
+        rows = iter(query.with_session(session))
+        head = list(itertools.islice(rows, STREAM_BATCH + 1))
+        if len(head) <= STREAM_BATCH:
+            return jsonify([to_dict(row) for row in head])
+        streaming = True
+    finally:
+        if not streaming:
+            session.close()
+    dumps = current_app.json.dumps
+
+    def generate():
+        separator, batch = '[', []
+        for row in itertools.chain(head, rows):
+            batch.append(to_dict(row))
+            if len(batch) == STREAM_BATCH:
+                yield separator + dumps(batch)[1:-1]
+                separator, batch = ',', []
+        if batch or separator == '[':
+            yield separator + dumps(batch)[1:-1]
+        yield ']'
+    response = current_app.response_class(stream_with_context(generate()), mimetype='application/json')
+    response.call_on_close(session.close)
+    return response
+
+def response_compressor(encoding):
+    # (feed, finish) of a streaming encoder
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=RESPONSE_BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(RESPONSE_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+def compressed_stream(chunks, encoding):
+    feed, finish = response_compressor(encoding)
+    for chunk in chunks:
+        data = feed(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+@bp.after_app_request
+def compress_response(response):
+    # Static files arrive with their ETag and any precompressed variant already chosen
+    if (not RESPONSE_COMPRESSION or request.method == 'HEAD' or response.direct_passthrough
+            or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers
+            or 'ETag' in response.headers or not response.mimetype.startswith(COMPRESSIBLE_TYPES + MSGPACK_MIMETYPES)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = next(
+        (e for e in ('br', 'gzip') if request.accept_encodings[e] and (e != 'br' or brotli is not None)), None
+    )
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # The size is unknown up front, so streams are always compressed
+        chunks = response.response
+        response.response = ClosingIterator(compressed_stream(chunks, encoding), getattr(chunks, 'close', None))
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < RESPONSE_COMPRESS_MIN_SIZE:
+            return response
+        feed, finish = response_compressor(encoding)
+        compressed = feed(body) + finish()
+        if len(compressed) >= len(body):
+            return response
+        response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def create_app(config=None):
+    # Cheap to call: nothing touches the database until a request does. The schema is managed by
+    # `python app.py migrate` (init_db()), scheduled jobs by `python app.py scheduler`.
+    app = Flask(__name__, static_folder=None)  # serve() handles the frontend
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.json = FastJSONProvider(app)
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('postgresql+psycopg2') and eventlet_patched():
+        make_psycopg2_green()
+
+    # Robust CORS for development and production
+    CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+    db.init_app(app)
+    jwt.init_app(app)
+    socketio.init_app(
+        app,
+        cors_allowed_origins="*",
+        async_mode='eventlet' if eventlet_patched() else 'threading',
+        message_queue=app.config['SOCKETIO_MESSAGE_QUEUE']
+    )
+    app.register_blueprint(bp)
+    if app.config['WARM_STATIC_FILES']:
+        socketio.start_background_task(static_files)
+    if MESSAGE_WRITE_BEHIND and uri.startswith('sqlite') and (
+            int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 or app.config['SOCKETIO_MESSAGE_QUEUE']):
+        # Each process would count message ids up from its own MAX(id) and hand out the same ones
+        raise RuntimeError('MESSAGE_WRITE_BEHIND on SQLite needs a single worker; use Postgres to run several')
+    # Workers see each other's sockets only through a shared store; other queue types keep per-worker presence
+    if (app.config['SOCKETIO_MESSAGE_QUEUE'] or '').startswith(('redis://', 'rediss://')):
+        presence.share(app.config['SOCKETIO_MESSAGE_QUEUE'])
+
+    if app.config['RUN_SCHEDULER']:
+        start_scheduler(app)
+    return app
 
 if __name__ == '__main__':
-    port = int(os.environ.get("PORT", 5000))
-    socketio.run(app, debug=True, host='0.0.0.0', port=port)
+    # python app.py [run|migrate|scheduler]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if command not in ('run', 'migrate', 'scheduler'):
+        sys.exit(f"Unknown command {command!r}, expected run, migrate or scheduler")
+
+    # The dev server is a single process, so it also runs the jobs
+    app = create_app({'RUN_SCHEDULER': command == 'run', 'WARM_STATIC_FILES': command == 'run'})
+    if command in ('run', 'migrate'):
+        with app.app_context():
+            init_db()
+    if command == 'scheduler':
+        start_scheduler(app, blocking=True)
+    elif command == 'run':
+        port = int(os.environ.get("PORT", 5000))
+        socketio.run(app, debug=True, host='0.0.0.0', port=port)
@@ -0,0 +1,287 @@
+"""Load test for the main HTTP routes and the `message` socket event.
+
+Seeds a database with a realistic amount of data: users, friendships, tasks
+with subtasks, months of messages, notifications and focus history. It then
+starts the app on a local port and drives /api/tasks, /api/messages,
+/api/friends, /api/notifications, /api/focus/track and the `message` socket
+event concurrently for --seconds. Throughput and p50/p95/p99 latency per
+operation are printed as JSON, so runs can be compared between commits. The
+data is generated from a fixed seed.
+
+Uses a throwaway SQLite database unless DATABASE_URL is set. A Postgres
+database given that way gets the seed rows added to it.
+
+    cd backend && python bench/api_load.py [--seconds 10] [--clients 16] [--socket-clients 4] [--users 200]
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Relative weight of each HTTP operation in the mix
+HTTP_MIX = {
+    'GET /api/tasks': 3,
+    'GET /api/messages': 3,
+    'GET /api/friends': 2,
+    'GET /api/notifications': 2,
+    'POST /api/focus/track': 1,
+}
+
+
+def seed(args):
+    sys.path.insert(0, BACKEND_DIR)
+    from werkzeug.security import generate_password_hash
+    from app import (
+        create_app, init_db, db, issue_token, conversation_key,
+        User, Friendship, Task, SubTask, Message, Notification, FocusDaily
+    )
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    # Nobody logs in with these, so a cheap hash keeps seeding fast
+    password = generate_password_hash('bench-password', method='pbkdf2:sha256:1000')
+    prefix = f'bench{uuid.uuid4().hex[:6]}_'
+    names = [f'{prefix}{i}' for i in range(args.users)]
+
+    def insert(model, rows):
+        for i in range(0, len(rows), 5000):
+            db.session.execute(model.__table__.insert(), rows[i:i + 5000])
+        return len(rows)
+
+    counts = {}
+    app = create_app()
+    with app.app_context():
+        init_db()
+        counts['users'] = insert(User, [
+            {'username': name, 'username_key': name.lower(), 'password': password,
+             'level': rng.randint(1, 20), 'xp': rng.randint(0, 99), 'total_focus_hours': 0.0}
+            for name in names
+        ])
+        ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(names)).all())
+
+        pairs = set()
+        for i, name in enumerate(names):
+            for j in rng.sample(range(args.users), min(args.friends, args.users - 1)):
+                if j != i:
+                    pairs.add((min(i, j), max(i, j)))
+        friendships = []
+        for i, j in sorted(pairs):
+            friendships.append({'user_id': ids[names[i]], 'friend_id': ids[names[j]], 'status': 'accepted'})
+            friendships.append({'user_id': ids[names[j]], 'friend_id': ids[names[i]], 'status': 'accepted'})
+        counts['friendships'] = insert(Friendship, friendships)
+
+        tasks, subtasks = [], []
+        for name in names:
+            for t in range(args.tasks):
+                task_id = str(uuid.UUID(int=rng.getrandbits(128)))
+                tasks.append({
+                    'id': task_id, 'title': f'Task {t}', 'description': 'Seeded by api_load',
+                    'priority': rng.choice(['low', 'normal', 'high']), 'status': rng.choice(['todo', 'doing', 'done']),
+                    'total_hours': rng.randint(1, 8), 'hours': rng.randint(0, 4), 'user_id': ids[name]
+                })
+                for s in range(args.subtasks):
+                    subtasks.append({
+                        'id': str(uuid.UUID(int=rng.getrandbits(128))), 'task_id': task_id,
+                        'title': f'Step {s}', 'completed': rng.random() < 0.5
+                    })
+        counts['tasks'] = insert(Task, tasks)
+        counts['subtasks'] = insert(SubTask, subtasks)
+
+        messages = []
+        for i, j in sorted(pairs):
+            for _ in range(int(args.days * args.messages_per_pair_day)):
+                sender, receiver = (names[i], names[j]) if rng.random() < 0.5 else (names[j], names[i])
+                messages.append({
+                    'text': 'x' * rng.randint(5, 120), 'sender': sender, 'receiver': receiver,
+                    'conversation': conversation_key(sender, receiver),
+                    'timestamp': now - timedelta(seconds=rng.randint(0, args.days * 86400))
+                })
+        messages.sort(key=lambda m: m['timestamp'])
+        counts['messages'] = insert(Message, messages)
+
+        notifications = []
+        for name in names:
+            for _ in range(args.notifications):
+                notifications.append({
+                    'user_id': ids[name], 'sender_username': rng.choice(names), 'title': 'Seeded',
+                    'message': 'Seeded by api_load', 'type': rng.choice(['info', 'friend_request', 'achievement']),
+                    'read': rng.random() < 0.8, 'timestamp': now - timedelta(seconds=rng.randint(0, args.days * 86400))
+                })
+        counts['notifications'] = insert(Notification, notifications)
+
+        counts['focus_days'] = insert(FocusDaily, [
+            {'user_id': ids[name], 'date': (now - timedelta(days=d)).strftime('%Y-%m-%d'), 'hours': rng.randint(0, 8) / 2}
+            for name in names for d in range(args.days)
+        ])
+        db.session.commit()
+
+        friends_of = {}
+        for i, j in pairs:
+            friends_of.setdefault(names[i], []).append(names[j])
+            friends_of.setdefault(names[j], []).append(names[i])
+        users = [
+            {'username': name, 'token': issue_token(db.session.get(User, ids[name])), 'friends': friends_of.get(name, [])}
+            for name in names[:max(args.clients, args.socket_clients)]
+        ]
+        return {'dialect': db.engine.dialect.name, 'counts': counts, 'users': users}
+
+
+def serve(port):
+    import eventlet
+    eventlet.monkey_patch(all=True)
+    sys.path.insert(0, BACKEND_DIR)
+    from app import create_app, socketio
+    socketio.run(create_app(), host='127.0.0.1', port=port, log_output=False)
+
+
+def percentiles(samples, errors, seconds):
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 1) if samples else None
+    return {
+        'requests': len(samples), 'errors': errors, 'throughput_per_sec': round(len(samples) / seconds, 1),
+        'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)
+    }
+
+
+def drive(base, users, args):
+    deadline = time.perf_counter() + args.seconds
+    results = {name: ([], [0]) for name in list(HTTP_MIX) + ['socket message']}
+    operations = [name for name, weight in HTTP_MIX.items() for _ in range(weight)]
+
+    def http_client(n):
+        rng = random.Random(args.seed + n)
+        user = users[n % len(users)]
+        http = requests.Session()
+        http.headers['Authorization'] = 'Bearer ' + user['token']
+        while time.perf_counter() < deadline:
+            name = rng.choice(operations)
+            method, path = name.split(' ')
+            params, body = None, None
+            if path == '/api/messages':
+                params = {'user2': rng.choice(user['friends'] or [user['username']])}
+            elif path == '/api/focus/track':
+                body = {'hours': 0.25}
+            started = time.perf_counter()
+            try:
+                ok = http.request(method, base + path, params=params, json=body, timeout=60).ok
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            samples, errors = results[name]
+            if ok:
+                samples.append(elapsed)
+            else:
+                errors[0] += 1
+
+    def socket_client(n):
+        import socketio
+        rng = random.Random(args.seed + 1000 + n)
+        user = users[n % len(users)]
+        sio = socketio.Client()
+        sio.connect(base, auth={'token': user['token']}, wait_timeout=30)
+        samples, errors = results['socket message']
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                sio.call('message', {'receiver': rng.choice(user['friends'] or [user['username']]), 'text': 'bench'}, timeout=60)
+                samples.append(time.perf_counter() - started)
+            except socketio.exceptions.TimeoutError:
+                errors[0] += 1
+        sio.disconnect()
+
+    threads = [threading.Thread(target=http_client, args=(n,)) for n in range(args.clients)]
+    threads += [threading.Thread(target=socket_client, args=(n,)) for n in range(args.socket_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report = {name: percentiles(samples, errors[0], args.seconds) for name, (samples, errors) in results.items()}
+    all_samples = [s for samples, _ in results.values() for s in samples]
+    report['total'] = percentiles(all_samples, sum(e[0] for _, e in results.values()), args.seconds)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent HTTP clients')
+    parser.add_argument('--socket-clients', type=int, default=4, help='concurrent Socket.IO senders')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--friends', type=int, default=10, help='friends picked per user')
+    parser.add_argument('--tasks', type=int, default=30, help='tasks per user')
+    parser.add_argument('--subtasks', type=int, default=4, help='subtasks per task')
+    parser.add_argument('--days', type=int, default=90, help='days of message, notification and focus history')
+    parser.add_argument('--messages-per-pair-day', type=float, default=0.5)
+    parser.add_argument('--notifications', type=int, default=100, help='notifications per user')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--child-seed', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_seed:
+        print(json.dumps(seed(args)))
+        return
+    if args.serve:
+        serve(args.serve)
+        return
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite:///' + tempfile.mktemp(suffix='.db'))
+    started = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, __file__, '--child-seed'] + sys.argv[1:],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    seeded = json.loads(out.strip().splitlines()[-1])
+    seed_seconds = time.perf_counter() - started
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, __file__, '--serve', str(port)], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(300):
+            try:
+                requests.get(base + '/api/health-check', timeout=5)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        report = drive(base, seeded['users'], args)
+    finally:
+        server.terminate()
+        server.wait()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    print(json.dumps({
+        'commit': commit or None,
+        'database': seeded['dialect'],
+        'seeded': dict(seeded['counts'], seconds=round(seed_seconds, 1)),
+        'seconds': args.seconds,
+        'clients': args.clients,
+        'socket_clients': args.socket_clients,
+        'operations': report,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
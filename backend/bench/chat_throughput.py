@@ -0,0 +1,76 @@
+"""Chat write throughput with and without the write-behind queue.
+
+Sends MESSAGES private messages through the real `message` socket handler and
+reports messages/sec for each mode. Uses a throwaway SQLite database unless
+DATABASE_URL is set.
+
+    cd backend && python bench/chat_throughput.py [--messages 2000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_once(messages):
+    sys.path.insert(0, BACKEND_DIR)
+    from app import create_app, init_db, socketio, write_behind, MESSAGE_WRITE_BEHIND
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+
+    client = app.test_client()
+    tokens = {}
+    for username in ('bench_sender', 'bench_receiver'):
+        client.post('/api/auth/register', json={'username': username, 'password': 'bench'})
+        login = client.post('/api/auth/login', json={'username': username, 'password': 'bench'})
+        tokens[username] = login.json['user']['token']
+    sender = socketio.test_client(app, auth={'token': tokens['bench_sender']})
+
+    started = time.perf_counter()
+    for i in range(messages):
+        sender.emit('message', {'receiver': 'bench_receiver', 'text': f'message {i}'})
+    acknowledged = time.perf_counter() - started
+    if MESSAGE_WRITE_BEHIND:
+        write_behind.flush()
+    persisted = time.perf_counter() - started
+
+    return {
+        'write_behind': MESSAGE_WRITE_BEHIND,
+        'messages': messages,
+        'ack_per_sec': round(messages / acknowledged),
+        'persisted_per_sec': round(messages / persisted),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_once(args.messages)))
+        return
+
+    # Each mode runs in its own process because the mode is read at import time
+    results = []
+    for write_behind in ('0', '1'):
+        env = dict(os.environ, MESSAGE_WRITE_BEHIND=write_behind)
+        env.setdefault('DATABASE_URL', 'sqlite:///' + tempfile.mktemp(suffix='.db'))
+        out = subprocess.run(
+            [sys.executable, __file__, '--child', '--messages', str(args.messages)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Do concurrent slow Postgres queries overlap under eventlet?
+
+Runs --queries green threads that each execute SELECT pg_sleep(--sleep) through
+the app's session and reports the wall time. With a cooperative driver the total
+stays close to one query; blocking I/O makes it the sum of all of them. For
+psycopg2 the run is repeated with the wait callback removed for comparison.
+Needs DATABASE_URL pointing at a Postgres server.
+
+    cd backend && DATABASE_URL=postgresql://... python bench/db_overlap.py [--queries 10] [--sleep 0.5]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(app, queries, sleep):
+    import eventlet
+    from sqlalchemy import text
+    from app import db
+
+    def slow_query():
+        with app.app_context():
+            db.session.execute(text('SELECT pg_sleep(:s)'), {'s': sleep})
+            db.session.remove()
+
+    pool = eventlet.GreenPool(queries)
+    started = time.perf_counter()
+    for _ in range(queries):
+        pool.spawn(slow_query)
+    pool.waitall()
+    elapsed = time.perf_counter() - started
+    return {'elapsed_sec': round(elapsed, 3), 'serial_sec': round(queries * sleep, 3), 'overlapped': elapsed < 2 * sleep}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queries', type=int, default=10)
+    parser.add_argument('--sleep', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL', '').startswith(('postgres://', 'postgresql')):
+        sys.exit('DATABASE_URL must point at a Postgres server')
+    os.environ.setdefault('DB_POOL_SIZE', str(args.queries))
+
+    import eventlet
+    eventlet.monkey_patch(all=True)
+    sys.path.insert(0, BACKEND_DIR)
+    from app import DATABASE_DRIVER, create_app, db
+
+    app = create_app()
+    results = [dict(driver=DATABASE_DRIVER, **run(app, args.queries, args.sleep))]
+    if DATABASE_DRIVER == 'psycopg2':
+        from psycopg2 import extensions
+        extensions.set_wait_callback(None)
+        with app.app_context():
+            db.engine.dispose()
+        results.append(dict(driver='psycopg2 without wait callback', **run(app, args.queries, args.sleep)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
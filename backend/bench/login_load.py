@@ -0,0 +1,138 @@
+"""Latency of a cheap endpoint while a login storm is running.
+
+Starts the app on a local port in a subprocess, measures GET /api/tasks on its
+own and then while --logins clients log in back to back, and reports
+p50/p95/p99 for both phases. The same run is repeated with hashing done inline
+on the eventlet hub, as it used to be, for comparison. Uses a throwaway SQLite
+database unless DATABASE_URL is set.
+
+    cd backend && python bench/login_load.py [--seconds 5] [--logins 8] [--readers 4]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(port, inline):
+    import eventlet
+    eventlet.monkey_patch(all=True)
+    sys.path.insert(0, BACKEND_DIR)
+    import app as app_module
+
+    if inline:
+        app_module.run_blocking = lambda fn, *args, **kwargs: fn(*args, **kwargs)
+    app = app_module.create_app()
+    with app.app_context():
+        app_module.init_db()
+    app_module.socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+
+def call(base, path, body=None, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = 'Bearer ' + token
+    req = urllib.request.Request(
+        base + path, data=json.dumps(body).encode() if body is not None else None, headers=headers
+    )
+    with urllib.request.urlopen(req, timeout=60) as resp:
+        return json.loads(resp.read())
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 1)
+    return {'requests': len(samples), 'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+def measure(base, token, seconds, readers, logins):
+    deadline = time.perf_counter() + seconds
+    latencies = []
+    login_count = [0]
+
+    def reader():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            call(base, '/api/tasks', token=token)
+            latencies.append(time.perf_counter() - started)
+
+    def login(i):
+        while time.perf_counter() < deadline:
+            call(base, '/api/auth/login', {'username': f'bench_login_{i}', 'password': 'bench-password'})
+            login_count[0] += 1
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=login, args=(i,)) for i in range(logins)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    result = percentiles(latencies)
+    if logins:
+        result['logins_per_sec'] = round(login_count[0] / seconds, 1)
+    return result
+
+
+def run_once(inline, args):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite:///' + tempfile.mktemp(suffix='.db'))
+    server = subprocess.Popen(
+        [sys.executable, __file__, '--serve', str(port)] + (['--inline'] if inline else []),
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(300):
+            try:
+                call(base, '/api/auth/login', {'username': '', 'password': ''})
+            except urllib.error.HTTPError:
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        for i in range(args.logins):
+            call(base, '/api/auth/register', {'username': f'bench_login_{i}', 'password': 'bench-password'})
+        call(base, '/api/auth/register', {'username': 'bench_reader', 'password': 'bench-password'})
+        token = call(base, '/api/auth/login', {'username': 'bench_reader', 'password': 'bench-password'})['user']['token']
+
+        return {
+            'hashing': 'inline' if inline else 'tpool',
+            'idle': measure(base, token, args.seconds, args.readers, 0),
+            'during_logins': measure(base, token, args.seconds, args.readers, args.logins),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--logins', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--inline', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.inline)
+        return
+
+    print(json.dumps([run_once(False, args), run_once(True, args)], indent=2))
+
+
+if __name__ == '__main__':
+    main()
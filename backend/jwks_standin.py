@@ -0,0 +1,86 @@
+"""Local stand-in for Google's ID-token signing keys, so Google sign-in works offline.
+
+Serves a JWKS at /certs (with a Cache-Control max-age like Google's) and mints
+ID tokens signed with the matching key at /token?email=... . It is meant for
+local development and tests only.
+
+    python jwks_standin.py --port 8765
+    GOOGLE_CERTS_URL=http://127.0.0.1:8765/certs python app.py
+    curl 'http://127.0.0.1:8765/token?email=someone@example.com'
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+CLIENT_ID = os.environ.get(
+    'GOOGLE_CLIENT_ID', '765015665790-79inqu25trcn7i8kmd4dq3n4rsse2j5a.apps.googleusercontent.com'
+)
+
+private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+key_id = uuid.uuid4().hex
+jwk = dict(json.loads(RSAAlgorithm.to_jwk(private_key.public_key())), kid=key_id, use='sig', alg='RS256')
+
+
+def mint(email, audience=CLIENT_ID, lifetime=3600):
+    now = int(time.time())
+    claims = {
+        'iss': 'https://accounts.google.com',
+        'aud': audience,
+        'sub': str(uuid.uuid5(uuid.NAMESPACE_URL, email).int)[:21],
+        'email': email,
+        'email_verified': True,
+        'iat': now,
+        'exp': now + lifetime,
+    }
+    return jwt.encode(claims, private_key, algorithm='RS256', headers={'kid': key_id})
+
+
+class Handler(BaseHTTPRequestHandler):
+    max_age = 3600
+    certs_requests = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/certs':
+            Handler.certs_requests += 1
+            self.reply({'keys': [jwk]}, {'Cache-Control': f'public, max-age={self.max_age}'})
+        elif url.path == '/token':
+            email = parse_qs(url.query).get('email', ['dev@example.com'])[0]
+            self.reply({'credential': mint(email)})
+        else:
+            self.send_error(404)
+
+    def reply(self, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"JWKS stand-in listening on http://{host}:{server.server_port}/certs")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    serve(args.host, args.port).serve_forever()
@@ -0,0 +1,169 @@
+"""Tiny Redis-compatible pub/sub server for running several workers on one machine.
+
+It only speaks the handful of commands the Socket.IO Redis manager needs
+(HELLO, PING, PUBLISH, SUBSCRIBE, UNSUBSCRIBE) and the shared presence registry
+needs (MULTI, EXEC, EXPIRE and the sorted set commands ZADD, ZREM, ZCARD, ZCOUNT,
+ZREMRANGEBYSCORE) over RESP2 or RESP3, keeps nothing on disk and is meant for
+local development and tests, not production.
+
+    python mq_standin.py --port 6380
+    SOCKETIO_MESSAGE_QUEUE=redis://127.0.0.1:6380/0 gunicorn --worker-class eventlet -w 4 "app:create_app()"
+"""
+import argparse
+import asyncio
+import time
+
+subscribers = {}  # channel -> set of StreamWriter
+protocols = {}  # StreamWriter -> negotiated RESP version
+sorted_sets = {}  # key -> {member: score}
+expires = {}  # key -> monotonic deadline
+
+
+def encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, dict):
+        return b'%%%d\r\n' % len(value) + b''.join(encode(k) + encode(v) for k, v in value.items())
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode(v) for v in value)
+    if isinstance(value, str):
+        value = value.encode()
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def encode_push(writer, values):
+    # RESP3 clients expect pub/sub frames as out-of-band pushes, RESP2 clients as plain arrays
+    frame = encode(values)
+    return b'>' + frame[1:] if protocols.get(writer) == 3 else frame
+
+
+def sorted_set(key):
+    if key in expires and expires[key] <= time.monotonic():
+        sorted_sets.pop(key, None)
+        expires.pop(key, None)
+    return sorted_sets.get(key, {})
+
+
+def in_range(score, low, high):
+    return float(low) <= score <= float(high)
+
+
+def run_key_command(command, args):
+    # Reply value for a keyspace command, or None when it is not one
+    if command == b'ZADD':
+        members = sorted_sets.setdefault(args[1], sorted_set(args[1]))
+        added = 0
+        for score, member in zip(args[2::2], args[3::2]):
+            added += member not in members
+            members[member] = float(score)
+        return added
+    if command == b'ZREM':
+        members = sorted_set(args[1])
+        return sum(members.pop(member, None) is not None for member in args[2:])
+    if command == b'ZREMRANGEBYSCORE':
+        members = sorted_set(args[1])
+        stale = [member for member, score in members.items() if in_range(score, args[2], args[3])]
+        for member in stale:
+            del members[member]
+        return len(stale)
+    if command == b'ZCARD':
+        return len(sorted_set(args[1]))
+    if command == b'ZCOUNT':
+        return sum(in_range(score, args[2], args[3]) for score in sorted_set(args[1]).values())
+    if command == b'EXPIRE':
+        if not sorted_set(args[1]):
+            return 0
+        expires[args[1]] = time.monotonic() + int(args[2])
+        return 1
+    return None
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Inline command, e.g. typed into telnet
+        return line.strip().split()
+    args = []
+    for _ in range(int(line[1:])):
+        size = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(size + 2))[:-2])
+    return args
+
+
+async def handle_client(reader, writer):
+    channels = set()
+    queued = None  # commands between MULTI and EXEC
+    try:
+        while True:
+            args = await read_command(reader)
+            if args is None:
+                break
+            if not args:
+                continue
+            command = args[0].upper()
+            if command == b'MULTI':
+                queued = []
+                writer.write(b'+OK\r\n')
+            elif command == b'EXEC':
+                replies = [run_key_command(args[0].upper(), args) for args in queued or []]
+                queued = None
+                writer.write(encode(replies))
+            elif queued is not None:
+                queued.append(args)
+                writer.write(b'+QUEUED\r\n')
+            elif (reply := run_key_command(command, args)) is not None:
+                writer.write(encode(reply))
+            elif command == b'HELLO':
+                protocols[writer] = int(args[1]) if len(args) > 1 else 2
+                info = {b'server': b'redis', b'version': b'7.0.0', b'proto': protocols[writer], b'mode': b'standalone'}
+                writer.write(encode(info) if protocols[writer] == 3 else encode([x for kv in info.items() for x in kv]))
+            elif command == b'PING':
+                writer.write(encode([b'pong', b'']) if channels and protocols.get(writer) != 3 else b'+PONG\r\n')
+            elif command == b'PUBLISH':
+                receivers = list(subscribers.get(args[1], ()))
+                for target in receivers:
+                    target.write(encode_push(target, [b'message', args[1], args[2]]))
+                writer.write(encode(len(receivers)))
+            elif command == b'SUBSCRIBE':
+                for channel in args[1:]:
+                    channels.add(channel)
+                    subscribers.setdefault(channel, set()).add(writer)
+                    writer.write(encode_push(writer, [b'subscribe', channel, len(channels)]))
+            elif command == b'UNSUBSCRIBE':
+                for channel in args[1:] or list(channels):
+                    channels.discard(channel)
+                    subscribers.get(channel, set()).discard(writer)
+                    writer.write(encode_push(writer, [b'unsubscribe', channel, len(channels)]))
+            elif command in (b'SELECT', b'QUIT'):
+                writer.write(b'+OK\r\n')
+                if command == b'QUIT':
+                    break
+            else:
+                writer.write(b'-ERR unknown command\r\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        for channel in channels:
+            subscribers.get(channel, set()).discard(writer)
+        protocols.pop(writer, None)
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_client, host, port)
+    print(f"Message queue stand-in listening on redis://{host}:{port}/0")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6380)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
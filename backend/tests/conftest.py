@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as flowstate  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = flowstate.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}"})
+    with app.app_context():
+        flowstate.init_db()
+    yield app
+    with app.app_context():
+        flowstate.db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    # Registers a user and returns (user id, auth headers)
+    def login(username, password='pw123456'):
+        client.post('/api/auth/register', json={'username': username, 'password': password})
+        user = client.post('/api/auth/login', json={'username': username, 'password': password}).get_json()['user']
+        return user['id'], {'Authorization': f"Bearer {user['token']}"}
+    return login
@@ -0,0 +1,94 @@
+import math
+import uuid
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+import app as flowstate
+from app import SubTask, Task, db
+
+SUBTASKS_PER_TASK = 3
+
+
+@contextmanager
+def count_statements(app):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def seed_tasks(app, user_id, count):
+    with app.app_context():
+        for _ in range(count):
+            task = Task(id=str(uuid.uuid4()), user_id=user_id, title='task')
+            db.session.add(task)
+            db.session.add_all(
+                SubTask(id=str(uuid.uuid4()), task_id=task.id, title='step', completed=False)
+                for _ in range(SUBTASKS_PER_TASK)
+            )
+        db.session.commit()
+
+
+def board_statements(app, client, headers):
+    # Statements issued by one GET /api/tasks, including the streamed part of the body
+    with count_statements(app) as statements:
+        response = client.get('/api/tasks', headers=headers)
+        tasks = response.get_json()
+    assert response.status_code == 200
+    assert all(len(task['subtasks']) == SUBTASKS_PER_TASK for task in tasks)
+    return len(tasks), len(statements)
+
+
+@pytest.fixture
+def board(app, client, login):
+    user_id, headers = login('alice')
+    client.get('/api/tasks', headers=headers)  # warm up caches so only the board's own queries are counted
+    seeded = 0
+
+    def grow_to(count):
+        nonlocal seeded
+        seed_tasks(app, user_id, count - seeded)
+        seeded = count
+        return board_statements(app, client, headers)
+    return grow_to
+
+
+def test_task_board_statement_count_does_not_grow_with_tasks(board):
+    counts = {}
+    for size in (1, 20, flowstate.STREAM_BATCH):
+        tasks, counts[size] = board(size)
+        assert tasks == size
+    assert len(set(counts.values())) == 1, counts
+
+
+def test_streamed_task_board_loads_subtasks_per_batch_not_per_task(board):
+    small, large = flowstate.STREAM_BATCH + 50, 3 * flowstate.STREAM_BATCH + 50
+    _, small_count = board(small)
+    tasks, large_count = board(large)
+    assert tasks == large
+    extra_batches = math.ceil(large / flowstate.STREAM_BATCH) - math.ceil(small / flowstate.STREAM_BATCH)
+    assert large_count - small_count <= extra_batches, (small_count, large_count)
+
+
+def test_task_response_shape(client, login):
+    _, headers = login('bob')
+    task_id = str(uuid.uuid4())
+    client.post('/api/tasks', headers=headers, json={'id': task_id, 'title': 'Write report', 'priority': 'high'})
+    client.patch(f'/api/tasks/{task_id}', headers=headers, json={
+        'subtasks': [{'id': 's1', 'title': 'Outline', 'completed': True}]
+    })
+    [task] = client.get('/api/tasks', headers=headers).get_json()
+    assert task['id'] == task_id
+    assert task['title'] == 'Write report'
+    assert task['priority'] == 'high'
+    assert task['subtasks'] == [{'id': 's1', 'title': 'Outline', 'completed': True}]
@@ -14,6 +14,8 @@ interface Message {
   timestamp: Date;
 }
 
+const PAGE_SIZE = 50;
+
 interface ChatWindowProps {
   friendName: string;
   friendAvatar?: string;
@@ -32,6 +34,7 @@ const ChatWindow = ({
   const [messages, setMessages] = useState<Message[]>([]);
   const [newMessage, setNewMessage] = useState("");
   const [isConnected, setIsConnected] = useState(socket.connected);
+  const [hasMore, setHasMore] = useState(false);
   const scrollRef = useRef<HTMLDivElement>(null);
 
   useEffect(() => {
@@ -62,18 +65,37 @@ const ChatWindow = ({
     };
   }, []);
 
-  // 1. Fetch Message History on Mount
+  // Join the conversation room so this chat receives its live messages
+  useEffect(() => {
+    const joinConversation = () => socket.emit("join_conversation", { with: friendName });
+
+    socket.on("connect", joinConversation);
+    if (socket.connected) joinConversation();
+
+    return () => {
+      socket.off("connect", joinConversation);
+      socket.emit("leave_conversation", { with: friendName });
+    };
+  }, [friendName]);
+
+  // 1. Fetch Message History on Mount (latest page only, older pages on demand)
+  const fetchHistory = (before?: string) =>
+    authFetch(`/api/messages?user2=${friendName}&limit=${PAGE_SIZE}${before ? `&before=${before}` : ""}`)
+      .then((res) => res.json())
+      .then((data) => {
+        setHasMore(data.length === PAGE_SIZE);
+        return data.map((msg: any) => ({
+          ...msg,
+          id: msg.id.toString(), // Ensure IDs are always strings
+          timestamp: new Date(msg.timestamp),
+        })) as Message[];
+      });
+
   useEffect(() => {
     if (currentUser && friendName) {
       console.log(`📥 Fetching chat history between ${currentUser} and ${friendName}`);
-      authFetch(`/api/messages?user1=${currentUser}&user2=${friendName}`)
-        .then((res) => res.json())
-        .then((data) => {
-          const parsedMessages = data.map((msg: any) => ({
-            ...msg,
-            id: msg.id.toString(), // Ensure IDs are always strings
-            timestamp: new Date(msg.timestamp),
-          }));
+      fetchHistory()
+        .then((parsedMessages) => {
           setMessages(parsedMessages);
           scrollToBottom();
         })
@@ -81,6 +103,13 @@ const ChatWindow = ({
     }
   }, [currentUser, friendName]);
 
+  const loadEarlier = () => {
+    if (!messages.length) return;
+    fetchHistory(messages[0].id)
+      .then((older) => setMessages((prev) => [...older, ...prev]))
+      .catch((err) => console.error("❌ Failed to fetch earlier messages:", err));
+  };
+
   // 2. Listen for Real-Time Messages
   useEffect(() => {
     const handleNewMessage = (msg: any) => {
@@ -209,6 +238,14 @@ const ChatWindow = ({
         ref={scrollRef}
         className="flex-1 overflow-y-auto px-4 py-6 space-y-6 scroll-smooth bg-muted/5"
       >
+        {hasMore && (
+          <button
+            onClick={loadEarlier}
+            className="block mx-auto text-xs text-muted-foreground hover:text-foreground"
+          >
+            Load earlier messages
+          </button>
+        )}
         {messages.map((message, idx) => {
           const isFile = message.text?.startsWith('file:');
           const fileUrl = isFile ? message.text?.replace('file:', '') : null;
@@ -8,6 +8,10 @@ export const socket = io(SOCKET_URL, {
     reconnection: true,
     reconnectionAttempts: 5,
     reconnectionDelay: 1000,
+    // Skip long-polling so requests don't need sticky sessions when the backend runs several workers
+    transports: ["websocket"],
+    // The server authenticates the socket and joins it to the user's room
+    auth: (cb) => cb({ token: localStorage.getItem("authToken") }),
 });
 
 export const initSocket = () => {
@@ -419,7 +419,7 @@ const Index = () => {
     authFetch(`/api/habits`, {
       method: 'PATCH',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ id: habitId, completion: newCompletion, username: currentUser }),
+      body: JSON.stringify({ id: habitId, day: dayIdx, done: newCompletion[dayIdx] === '1' }),
     }).catch(err => {
       console.error(`Failed to toggle habit ${habitId}:`, err);
       fetchHabits(currentUser); // Rollback